@@ -63,9 +63,32 @@ def create_app(config_name):
     app.register_blueprint(server_blueprint, url_prefix='/servers')
     app.register_blueprint(user_blueprint, url_prefix='/users')
 
+    _count_queries(app)
+
+    # 注册执行记录状态变化的监听，状态变化提交后通知查询状态的页面
+    from . import record_state  # noqa
+
     return app
 
 
+def _count_queries(app):
+    """统计每个请求执行的sql数，通过X-Query-Count响应头返回。"""
+    from flask import g, has_app_context
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if has_app_context():
+            g.query_count = g.get('query_count', 0) + 1
+
+    @app.after_request
+    def add_query_count(response):
+        response.headers['X-Query-Count'] = str(g.get('query_count', 0))
+        app.logger.debug(f'{g.get("query_count", 0)} queries executed')
+        return response
+
+
 def create_celery(app):
     celery = Celery(
         app.import_name,
@@ -0,0 +1,47 @@
+# coding=utf-8
+
+"""
+celery任务参数中较大内容的暂存（claim check），任务参数中只传递引用，内容在redis中按过期时间自动清理。
+"""
+
+import uuid
+
+import redis
+
+r = redis.Redis('localhost')
+
+BLOB_TTL = 24 * 3600  # 暂存内容的保留时间（秒），任务未执行或执行失败时到期自动删除
+
+
+def put(data, ttl=BLOB_TTL):
+    """暂存内容。
+
+    :param data: 二进制内容
+    :type data: bytes
+    :param ttl: 保留时间（秒）
+    :type ttl: int
+    :return: 内容的引用
+    """
+    key = f'blob:{uuid.uuid4().hex}'
+    r.set(key, data, ex=ttl)
+    return key
+
+
+def get(key):
+    """读取暂存的内容。
+
+    :param key: put返回的引用
+    :type key: str
+    :return: 二进制内容
+    :raise KeyError: 内容不存在或已过期
+    """
+    data = r.get(key)
+    if data is None:
+        raise KeyError(key)
+    return data
+
+
+def delete(*keys):
+    """删除暂存的内容。"""
+    if keys:
+        r.delete(*keys)
@@ -1,52 +1,119 @@
 # coding=utf-8
 
+import json
+import time
+import uuid
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
 import redis
-from flask import current_app
+from flask import current_app, render_template
+from jenkins import JenkinsException, NotFoundException
 
-from . import db, jenkins, celery_app
-from .tools import gen_analysis_pic, get_sftp_file
-from .models import Record, Project, Task, Result, EmailTemplate
+from . import db, jenkins, celery_app, blob_store
+from .tools import gen_analysis_pic, analysis_legend, get_sftp_file, smtp_pool
+from .jenkins_api import (get_builds, get_nodes, get_node_info, queue_build, get_queue_item, cancel_queue_item,
+                          reconfig_job)
+from .dispatch import next_records
+from .job.junit import iter_cases
+from .job_config import set_node, config_hash
+from .models import (Record, Task, Result, EmailTemplate, TestCase, TestCaseHistory, TaskDailyStat,
+                     ProjectDailyStat, Project, Server)
 
 r = redis.Redis('localhost')
 
+RESULT_FIELDS = ('tests', 'errors', 'failures', 'skip')
+TEST_CASE_BATCH_SIZE = 1000  # 用例结果每批写入的行数
+RESULT_EXPIRE = 7 * 24 * 3600  # 上报结果在redis中的保留时间（秒），构建一直未结束时自动清理
+
+MAIL_QUEUE = 'mail:queue'  # 待发送邮件队列
+MAIL_DISPATCH_FLAG = 'mail:dispatching'  # 已触发发送任务的标记
+MAIL_DISPATCH_FLAG_EXPIRE = 300  # 标记的过期时间（秒），发送任务丢失时不影响之后的触发
+MAIL_RETRY_DELAY = 60  # 连接邮件服务器失败后重试的等待时间（秒）
+MIGRATION_EXPIRE = 7 * 24 * 3600  # 修改测试服务器的进度在redis中的保留时间（秒）
+MIGRATION_LEASE = 300  # 迁移中超过该时间（秒）没有进展时认为执行迁移的worker已退出，可以继续或回滚
+MIGRATION_GUARD_TIMEOUT = 10  # 检查并修改迁移状态期间持有的锁的过期时间（秒）
+NODE_SNAPSHOT = 'nodes:snapshot'  # 测试服务器状态快照，以hash存放，键为服务器地址
+# 快照的过期时间（秒），为几个采集周期，采集停止后不再使用过期的状态，改为实时查询jenkins
+NODE_SNAPSHOT_EXPIRE = 30
+DISPATCH_LOCK_TIMEOUT = 60  # 派发锁的过期时间（秒）
+
+# 派发锁的值为持有者的随机token，只有token一致时才释放或延长，锁过期后被其他进程取得时不会误操作
+_release_lock = r.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+_extend_lock = r.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+
+def digest_key(project_id):
+    """项目汇总邮件中待发送的执行记录在redis中的键，以列表存放。"""
+    return f'mail:digest:{project_id}'
+
+
+def result_key(project_name, task_name, build_number):
+    """某次构建上报的测试结果在redis中的键，结果以hash存放。"""
+    return f'result:{project_name}:{task_name}:{build_number}'
 
-@celery_app.task(name='app.celery_tasks.send_email')
-def send_email(host, sender, pwd, receivers, subject, content, result=None, attachments=None, content_type='html'):
-    """发送邮件。
 
-    :param host: 邮件发送服务器
-    :type host: str
-    :param sender: 邮件发送账号
-    :type sender: str
-    :param pwd: 邮件发送账号的密码
-    :type pwd: str
+def send_email(receivers, subject, content, result=None, attachments=None, content_type='html'):
+    """将邮件加入发送队列，由dispatch_mail通过连接池批量发送。
+
     :param receivers: 邮件接收地址
     :type receivers: list
     :param subject: 邮件主题
     :type subject: str
     :param content: 邮件正文
     :type content: str
-    :param result: 测试结果数据，由测试用例数、出错数、失败数、跳过数组成的元组
-    :type result: tuple
-    :param attachments: 附件，传入各附件组成的列表，每个附件为附件名、附件二进制内容组成的元组
+    :param result: 测试结果数据，由测试用例数、出错数、失败数、跳过数组成的列表
+    :type result: list
+    :param attachments: 附件，传入各附件组成的列表，每个附件为附件名、附件内容在blob_store中的引用组成的列表，
+                        发送后删除暂存的附件内容
     :type attachments: list
     :param content_type: 邮件正文格式，可传入'html'、'plain'等，默认'html'
     :type content_type: str
     """
-    import smtplib
+    r.rpush(MAIL_QUEUE, json.dumps({
+        'receivers': receivers,
+        'subject': subject,
+        'content': content,
+        'result': result,
+        'attachments': attachments or [],
+        'content_type': content_type
+    }))
+
+    # 已有待执行的发送任务时不再重复触发
+    if r.set(MAIL_DISPATCH_FLAG, 1, ex=MAIL_DISPATCH_FLAG_EXPIRE, nx=True):
+        dispatch_mail.delay()
+
+
+def _build_message(sender, mail):
+    """根据队列中的邮件生成MIME邮件，附件已过期时抛出KeyError。"""
     from email import encoders
     from email.header import Header
     from email.mime.text import MIMEText
     from email.mime.base import MIMEBase
     from email.mime.multipart import MIMEMultipart
 
+    content = mail['content']
+    result = mail['result']
+
     msg = MIMEMultipart()
     msg['From'] = f'Polaris 通知 <{sender}>'
-    msg['To'] = ', '.join(receivers)
-    msg['Subject'] = Header(subject, 'utf-8')
+    msg['To'] = ', '.join(mail['receivers'])
+    msg['Subject'] = Header(mail['subject'], 'utf-8')
 
     if result:
-        result_pic = gen_analysis_pic(result[2], result[0] - result[1] - result[2] - result[3], result[3], result[1])
+        counts = (result[2], result[0] - result[1] - result[2] - result[3], result[3], result[1])
+        result_pic = gen_analysis_pic(*counts)
         att = MIMEBase('image', 'png', filename='analysis.png')
         att.add_header('Content-Disposition', 'attachment', filename='analysis.png')
         att.add_header('Content-ID', '<0>')
@@ -55,7 +122,7 @@ def send_email(host, sender, pwd, receivers, subject, content, result=None, atta
         encoders.encode_base64(att)
         msg.attach(att)
 
-        content = content.replace('${analysis_pic}', '<img src="cid:0" />')
+        content = content.replace('${analysis_pic}', f'<img src="cid:0" /><br>{analysis_legend(*counts)}')
         content = content.replace('${tests}', f'{result[0]}')
         content = content.replace('${pass}', f'{result[0] - result[1] - result[2] - result[3]}')
         content = content.replace('${failures}', f'{result[2]}')
@@ -63,98 +130,859 @@ def send_email(host, sender, pwd, receivers, subject, content, result=None, atta
         content = content.replace('${skip}', f'{result[3]}')
 
     # 正文
-    msg.attach(MIMEText(content, content_type, 'utf-8'))
+    msg.attach(MIMEText(content, mail['content_type'], 'utf-8'))
+
+    for attachment_name, attachment_key in mail['attachments']:
+        att = MIMEText(blob_store.get(attachment_key), 'base64', 'utf-8')
+        att["Content-Type"] = 'application/octet-stream'
+        att["Content-Disposition"] = f'attachment; filename="{attachment_name}"'
+        msg.attach(att)
+
+    return msg
+
+
+@celery_app.task(name='app.celery_tasks.dispatch_mail')
+def dispatch_mail():
+    """分批取出发送队列中的邮件，通过worker进程中复用的连接发送，直到队列为空。
+
+    单封邮件无法生成或被服务器拒绝时记录后丢弃；连接失败或断开时将未发送的邮件放回队列头部，稍后重试。
+    """
+    import smtplib
+
+    # 先清除标记再取队列，之后加入的邮件会触发新的发送任务
+    r.delete(MAIL_DISPATCH_FLAG)
+
+    sender = current_app.config['EMAIL_SENDER']
+    batch_size = current_app.config['POLARIS_MAIL_BATCH_SIZE']
+    sent = 0
+
+    while True:
+        pipe = r.pipeline()
+        pipe.lrange(MAIL_QUEUE, 0, batch_size - 1)
+        pipe.ltrim(MAIL_QUEUE, batch_size, -1)
+        batch = pipe.execute()[0]
+        if not batch:
+            break
+
+        pending = list(batch)
+        try:
+            with smtp_pool.connection(current_app.config['EMAIL_HOST'], sender,
+                                      current_app.config['EMAIL_SENDER_PASSWORD'],
+                                      current_app.config['EMAIL_USE_SSL']) as smtp:
+                while pending:
+                    raw = pending.pop(0)
+                    try:
+                        mail = json.loads(raw.decode('utf-8'))
+                    except ValueError:
+                        current_app.logger.error(f'invalid mail dropped: {raw[:200]!r}')
+                        continue
+
+                    try:
+                        smtp.sendmail(sender, mail['receivers'], _build_message(sender, mail).as_string())
+                        sent += 1
+                    except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError):
+                        # 连接级错误，该邮件和之后的邮件放回队列
+                        pending.insert(0, raw)
+                        raise
+                    except smtplib.SMTPException as e:
+                        # 服务器拒绝或不接受该邮件，丢弃该邮件，继续发送之后的邮件
+                        current_app.logger.error(f'mail "{mail.get("subject")}" refused: {e}')
+                    except OSError:
+                        pending.insert(0, raw)
+                        raise
+                    except KeyError as e:
+                        current_app.logger.error(f'attachment {e} of mail "{mail.get("subject")}" expired')
+                    except Exception as e:
+                        # 生成邮件出错，丢弃该邮件，不影响之后的邮件
+                        current_app.logger.error(f'build mail "{mail.get("subject")}" error')
+                        current_app.logger.exception(e)
+
+                    blob_store.delete(*[attachment_key for _, attachment_key in mail.get('attachments', [])])
+        except (smtplib.SMTPException, OSError) as e:
+            current_app.logger.error('send mail error')
+            current_app.logger.exception(e)
+
+            r.lpush(MAIL_QUEUE, *reversed(pending))
+            dispatch_mail.apply_async(countdown=MAIL_RETRY_DELAY)
+            break
+
+    current_app.logger.info(f'sent {sent} mails')
+
+
+def finalize_record(rcd, build_result, console_output, duration=None):
+    """根据jenkins的构建结果结束执行记录，生成测试结果并累加到每日统计中，调用方负责提交会话。
+
+    构建事件和定时检查可能同时结束同一记录，先以条件更新认领执行中的记录，更新到的行在提交前保持锁定，
+    另一方的条件更新等待其提交后不再匹配，不会重复生成结果、累加统计。
+
+    :param rcd: 执行记录
+    :type rcd: Record
+    :param build_result: jenkins构建结果，如'SUCCESS'、'FAILURE'
+    :type build_result: str
+    :param console_output: 构建的控制台输出
+    :type console_output: str
+    :param duration: 构建耗时（毫秒），未知时按记录创建至今计算
+    :type duration: int
+    :return: 测试结果，记录已被其他进程结束时为None
+    """
+    state = 1 if build_result == 'SUCCESS' else -1
+    if not Record.query.filter_by(id=rcd.id, state=0).update({'state': state}, synchronize_session=False):
+        current_app.logger.info(f'{rcd} already finalized')
+        db.session.expire(rcd)
+        return None
+
+    test_result = Result(record=rcd, status=0 if build_result == 'SUCCESS' else -1,
+                         tests=0, errors=0, failures=0, skip=0)
+    test_result.set_console(console_output)
+
+    # 读取并删除该构建上报的结果，一次往返完成
+    with r.pipeline() as pipe:
+        pipe.hgetall(result_key(rcd.project.name, rcd.task.nickname, rcd.build_number))
+        pipe.delete(result_key(rcd.project.name, rcd.task.nickname, rcd.build_number))
+        report, _ = pipe.execute()
+    report = {field.decode('utf-8'): value for field, value in report.items()}
+
+    if not report:
+        # 未携带构建号的上报按顺序存放在各字段的列表中
+        with r.pipeline() as pipe:
+            for field in RESULT_FIELDS:
+                pipe.lpop(f'result:{field}:{rcd.project.name}:{rcd.task.nickname}')
+            values = pipe.execute()
+        if values[0]:
+            report = dict(zip(RESULT_FIELDS, values))
+
+    if report:
+        test_result.tests += int(report.get('tests', 0))
+        test_result.errors += int(report.get('errors', 0))
+        test_result.failures += int(report.get('failures', 0))
+        test_result.skip += int(report.get('skip', 0))
+
+    db.session.add(test_result)
+
+    # 数据库中已更新，再设置属性以触发状态变化的通知
+    current_app.logger.debug('{} {}'.format(rcd, 'success' if state == 1 else 'fail'))
+    rcd.state = state
+    rcd.result = test_result
+
+    if duration is None:
+        duration = int((datetime.utcnow() - rcd.timestamp).total_seconds() * 1000)
+    TaskDailyStat.increase(rcd, test_result, duration)
+    ProjectDailyStat.increase(rcd, test_result, duration)
+
+    return test_result
+
+
+def post_finalize(rcd):
+    """执行记录结束并提交后的后续处理：解析测试报告中的用例结果、发送通知邮件、派发等待执行的记录。
+
+    :param rcd: 已结束的执行记录
+    :type rcd: Record
+    """
+    if rcd.task.junit_report:
+        ingest_test_cases.delay(rcd.id)
+
+    # 附件读取和邮件发送在celery中进行，不阻塞请求
+    if rcd.task.email_notification_enable and rcd.task.email_receivers:
+        notify_result.delay(rcd.id)
+
+    # 释放了一个执行器，派发服务器队列中等待的记录
+    dispatch_records.delay(rcd.project.server_id)
+
+
+@celery_app.task(name='app.celery_tasks.ingest_test_cases')
+def ingest_test_cases(record_id):
+    """从测试服务器读取执行记录的JUnit XML测试报告，流式解析并分批写入各用例的执行结果，同时更新用例的执行历史。
+
+    :param record_id: 执行记录id
+    :type record_id: int
+    """
+    rcd = Record.query.get(record_id)
+    server = rcd.project.server
+
+    # 重试时覆盖之前写入的部分结果
+    rcd.test_cases.delete()
+
+    count = 0
+    batch = []
+    try:
+        with get_sftp_file(server.host, server.username, server.password, rcd.task.junit_report, 'rb') as fp:
+            for case in iter_cases(fp):
+                case['record_id'] = rcd.id
+                batch.append(case)
 
-    if attachments:
-        for attachment_name, attachment_content in attachments:
-            att = MIMEText(attachment_content, 'base64', 'utf-8')
-            att["Content-Type"] = 'application/octet-stream'
-            att["Content-Disposition"] = f'attachment; filename="{attachment_name}"'
-            msg.attach(att)
+                if len(batch) >= TEST_CASE_BATCH_SIZE:
+                    _store_test_cases(rcd, batch)
+                    count += len(batch)
+                    batch = []
+    except FileNotFoundError:
+        current_app.logger.error(f'junit report of {rcd} not found')
+        return
 
-    smtp = smtplib.SMTP_SSL(host)
-    smtp.login(sender, pwd)
-    smtp.sendmail(sender, receivers, msg.as_string())
-    smtp.quit()
+    _store_test_cases(rcd, batch)
+    count += len(batch)
+    db.session.commit()
+
+    current_app.logger.info(f'ingested {count} test cases of {rcd}')
+
+
+def _store_test_cases(rcd, cases):
+    """写入一批用例结果，并计入各用例的执行历史。"""
+    db.session.bulk_insert_mappings(TestCase, cases)
+    TestCaseHistory.update(rcd, cases)
+    db.session.flush()
+
+
+def _fetch_attachments(server, paths):
+    """并发读取测试服务器上的附件，单个文件受大小上限和超时时间限制。
+
+    :return: 与paths一一对应的列表，元素为文件内容或读取时的异常
+    """
+    import paramiko
+
+    max_size = current_app.config['POLARIS_ATTACHMENT_MAX_SIZE']
+    timeout = current_app.config['POLARIS_ATTACHMENT_TIMEOUT']
+
+    def fetch(path):
+        try:
+            with get_sftp_file(server.host, server.username, server.password, path, 'rb',
+                               max_size=max_size, timeout=timeout) as fp:
+                return fp.read()
+        except (OSError, paramiko.SSHException, EOFError) as e:
+            # 包括认证失败、连接被断开，只跳过该附件，不影响邮件发送
+            return e
+
+    with ThreadPoolExecutor(max_workers=current_app.config['POLARIS_ATTACHMENT_WORKERS']) as executor:
+        return list(executor.map(fetch, paths))
+
+
+def _receivers(task):
+    """任务的邮件接收地址列表。"""
+    return task.email_receivers.replace('， ', ',').replace(', ', ',').replace('，', ',').split(',')
+
+
+def _collect_attachments(rcd):
+    """读取执行记录的附件和控制台输出并暂存到blob_store中。
+
+    :return: 由附件名、暂存引用组成的列表
+    """
+    paths = [path for path in (rcd.task.email_attachments or '').split(';') if path.strip()]
+    current_app.logger.debug(f'reading remote files: {paths}')
+
+    attachments = []
+    for path, data in zip(paths, _fetch_attachments(rcd.project.server, paths)):
+        if isinstance(data, Exception):
+            current_app.logger.error(f'read remote file {path} error: {data}')
+            continue
+        attachments.append([path.replace('\\', '/').split('/')[-1], blob_store.put(data)])
+    attachments.append(['console.log', blob_store.put(b''.join(
+        text.replace('\n', '\r\n').encode('utf8') for text in rcd.result.iter_console()))])
+
+    return attachments
+
+
+@celery_app.task(name='app.celery_tasks.notify_result')
+def notify_result(record_id):
+    """读取附件并发送执行记录的结果邮件，项目设置了汇总窗口时加入项目的汇总邮件。
+
+    :param record_id: 已结束的执行记录id
+    :type record_id: int
+    """
+    rcd = Record.query.get(record_id)
+    test_result = rcd.result
+    attachments = _collect_attachments(rcd)
+
+    window = rcd.project.digest_window
+    if window:
+        # 窗口内第一个结束的执行记录负责定时发送汇总邮件
+        if r.rpush(digest_key(rcd.project_id), json.dumps({'record_id': rcd.id, 'attachments': attachments})) == 1:
+            send_digest.apply_async((rcd.project_id,), countdown=window * 60)
+        return
+
+    send_email(_receivers(rcd.task), f'{rcd.task.name} 测试结果：{"成功" if rcd.state == 1 else "失败"}',
+               rcd.task.email_body_html or
+               EmailTemplate.query.order_by(EmailTemplate.timestamp.desc()).first().body_html,
+               [test_result.tests, test_result.errors, test_result.failures, test_result.skip]
+               if test_result.tests != 0 else None, attachments)
+
+
+@celery_app.task(name='app.celery_tasks.send_digest')
+def send_digest(project_id):
+    """将项目汇总窗口内结束的执行记录合并为一封邮件发送，附件名前加上任务名。
+
+    :param project_id: 项目id
+    :type project_id: int
+    """
+    pipe = r.pipeline()
+    pipe.lrange(digest_key(project_id), 0, -1)
+    pipe.delete(digest_key(project_id))
+    entries = [json.loads(entry.decode('utf-8')) for entry in pipe.execute()[0]]
+    if not entries:
+        return
+
+    attachments = {entry['record_id']: entry['attachments'] for entry in entries}
+    records = Record.query.options(db.joinedload('task'), db.joinedload('result')).filter(
+        Record.id.in_(attachments)).order_by(Record.id).all()
+    if not records:
+        # 执行记录已被删除（如删除了任务）
+        current_app.logger.warning(f'records {list(attachments)} of digest not found')
+        blob_store.delete(*[key for entry in entries for _, key in entry['attachments']])
+        return
+
+    receivers = []
+    digest_attachments = []
+    totals = [0, 0, 0, 0]
+    for rcd in records:
+        receivers.extend(receiver for receiver in _receivers(rcd.task) if receiver not in receivers)
+        digest_attachments.extend([f'{rcd.task.name}_{name}', key] for name, key in attachments[rcd.id])
+        for i, field in enumerate(RESULT_FIELDS):
+            totals[i] += getattr(rcd.result, field)
+
+    failed = sum(1 for rcd in records if rcd.state != 1)
+    content = render_template('email/digest.html', records=records, failed=failed,
+                              analysis_pic=totals[0] != 0)
+    send_email(receivers, f'{records[0].project.name} 测试结果汇总：{len(records)}个任务，{failed}个失败', content,
+               totals if totals[0] != 0 else None, digest_attachments)
+
+
+def _poll(fun, items, workers=None):
+    """在有界线程池中并发调用jenkins接口，线程中只访问jenkins，不访问数据库会话。
+
+    :param fun: 以单个item为参数的调用
+    :param items: 参数列表，元素需可哈希
+    :param workers: 最大并发数，默认为POLARIS_JENKINS_POLL_WORKERS
+    :return: item到调用结果的字典，调用出错时结果为对应的JenkinsException
+    """
+    app = current_app._get_current_object()
+
+    def call(item):
+        with app.app_context():
+            try:
+                return fun(item)
+            except JenkinsException as e:
+                return e
+
+    with ThreadPoolExecutor(max_workers=workers or app.config['POLARIS_JENKINS_POLL_WORKERS']) as executor:
+        return dict(zip(items, executor.map(call, items)))
+
+
+def dispatched_records(task):
+    """任务中已派发到jenkins、尚未开始执行的记录，开始执行后根据构建的队列项id确定其构建号。
+
+    :return: 队列项id到记录的字典
+    """
+    return {rcd.queue_id: rcd for rcd in Record.query.filter(
+        Record.task_id == task.id, Record.state == 0, Record.build_number.is_(None), Record.queue_id.isnot(None))}
 
 
 @celery_app.task(name='app.celery_tasks.check_state')
 def check_state():
-    """检查所有任务的执行状态。"""
-
-    projects = Project.query.all()
-    for p in projects:
-        tasks = Task.query.filter_by(project=p).all()
-        for task in tasks:
-            job_info = jenkins._server.get_job_info(task.name)
-            builds = job_info['builds'][::-1]
-            for build in builds:
-                build_number = build['number']
-
-                # 根据jenkins的构建记录查询数据库中的记录
-                rcd = Record.query.filter_by(task=task).filter_by(build_number=build_number).first()
-
-                # 数据库中没有该记录，则添加进去
-                if rcd is None:
-                    rcd = Record(user=None, project=p, task=task, state=0, version='9999',
-                                 build_number=build_number)
-                    db.session.add(rcd)
-                    db.session.commit()
-
-                if rcd.state == -2:
-                    rcd.state = 0
-                    db.session.commit()
-
-                # 查询记录是否已经执行完毕
-                if rcd.state == 0:
-                    build_info = jenkins._server.get_build_info(rcd.task.name, rcd.build_number)
-                    if build_info['result']:
-                        console_output = jenkins._server.get_build_console_output(rcd.task.name, rcd.build_number)
-
-                        test_result = Result(record=rcd, status=0 if build_info['result'] == 'SUCCESS' else -1,
-                                             cmd_line=console_output, tests=0, errors=0, failures=0, skip=0)
-
-                        tests = r.lpop(f'result:tests:{rcd.project.name}:{rcd.task.nickname}')
-                        errors = r.lpop(f'result:errors:{rcd.project.name}:{rcd.task.nickname}')
-                        failures = r.lpop(f'result:failures:{rcd.project.name}:{rcd.task.nickname}')
-                        skip = r.lpop(f'result:skip:{rcd.project.name}:{rcd.task.nickname}')
-
-                        if tests:
-                            test_result.tests += int(tests)
-                            test_result.errors += int(errors)
-                            test_result.failures += int(failures)
-                            test_result.skip += int(skip)
-
-                        db.session.add(test_result)
-
-                        if build_info['result'] == 'SUCCESS':
-                            rcd.state = 1
-                        else:
-                            rcd.state = -1
-                        rcd.result = test_result
-                        db.session.commit()
-
-                        if rcd.task.email_notification_enable and rcd.task.email_receivers:
-                            receivers = rcd.task.email_receivers.replace('， ', ',').replace(', ', ',').replace('，', ',')
-                            receivers = receivers.split(',')
-
-                            attachments = []
-                            for att in rcd.task.email_attachments.split(';'):
-                                current_app.logger.debug(f'reading remote file: {att}')
-                                try:
-                                    with get_sftp_file(rcd.project.server.host, rcd.project.server.username,
-                                                       rcd.project.server.password, att, 'rb') as fp:
-                                        data = fp.read()
-                                        attachments.append((att.replace('\\', '/').split('/')[-1], data))
-                                except FileNotFoundError:
-                                    current_app.logger.error('file not found')
-                            attachments.append(
-                                ('console.log', test_result.cmd_line.replace('\n', '\r\n').encode('utf8')))
-
-                            send_email.delay(current_app.config['EMAIL_HOST'], current_app.config['EMAIL_SENDER'],
-                                             current_app.config['EMAIL_SENDER_PASSWORD'],
-                                             receivers, f'{rcd.task.name} 测试结果：{"成功" if rcd.state == 1 else "失败"}',
-                                             rcd.task.email_body_html or EmailTemplate.query.order_by(
-                                                 EmailTemplate.timestamp.desc()).first().body_html,
-                                             (test_result.tests, test_result.errors, test_result.failures,
-                                              test_result.skip) if test_result.tests != 0 else None, attachments)
+    """检查所有任务的执行状态。
+
+    只向jenkins查询比任务同步水位新的构建，水位推进到最早一个仍未结束的构建之前，已结束的历史构建不再重复检查。
+    jenkins请求在有界线程池中并发执行，所有数据库修改在最后一次提交。
+    """
+    tasks = Task.query.all()
+    builds_of = _poll(lambda item: get_builds(*item), [(t.name, t.synced_build_number or 0) for t in tasks])
+
+    # 根据jenkins的构建记录查询数据库中的记录，数据库中没有的记录则添加进去
+    pending = []
+    for task in tasks:
+        builds = builds_of[(task.name, task.synced_build_number or 0)]
+        if isinstance(builds, JenkinsException):
+            current_app.logger.error(f'get builds of {task} error', exc_info=builds)
+            continue
+        if not builds:
+            continue
+
+        # 等待执行的记录尚未派发，其构建号是旧版本猜测的，不据此对应构建
+        records = {rcd.build_number: rcd for rcd in Record.query.filter(
+            Record.task_id == task.id, Record.state != -2,
+            Record.build_number.in_([build['number'] for build in builds]))}
+        dispatched = dispatched_records(task)
+
+        watermark = None
+        for build in builds:
+            build_number = build['number']
+
+            rcd = records.get(build_number)
+            if rcd is None:
+                rcd = dispatched.pop(build.get('queueId'), None)
+            if rcd is None:
+                rcd = Record(user=None, project=task.project, task=task, state=0, version='9999')
+                db.session.add(rcd)
+            rcd.build_number = build_number
+
+            # 记录已执行完毕，待获取控制台输出后入库
+            if rcd.state == 0 and build['result']:
+                pending.append((rcd, build))
+            # 水位只能推进到第一个仍未结束的构建之前
+            elif watermark is None and rcd.state == 0:
+                watermark = build_number - 1
+
+        task.synced_build_number = builds[-1]['number'] if watermark is None else watermark
+
+    # 新添加的记录写入数据库，生成默认的创建时间和外键，结束记录时累加每日统计需要用到
+    db.session.flush()
+
+    console_outputs = _poll(lambda item: jenkins._server.get_build_console_output(*item),
+                            [(rcd.task.name, rcd.build_number) for rcd, _ in pending])
+
+    finished = []
+    for rcd, build in pending:
+        console_output = console_outputs[(rcd.task.name, rcd.build_number)]
+        if isinstance(console_output, JenkinsException):
+            # 本次无法入库，水位退回到该构建之前，下次检查时重试
+            current_app.logger.error(f'get console output of {rcd} error', exc_info=console_output)
+            rcd.task.synced_build_number = min(rcd.task.synced_build_number, rcd.build_number - 1)
+            continue
+
+        # 每条记录在各自的保存点中结束，单条记录出错只回滚该记录，不影响同一次检查中的其他记录
+        try:
+            with db.session.begin_nested():
+                test_result = finalize_record(rcd, build['result'], console_output, build['duration'])
+        except Exception as e:
+            current_app.logger.error(f'finalize {rcd} error', exc_info=e)
+            rcd.task.synced_build_number = min(rcd.task.synced_build_number, rcd.build_number - 1)
+            continue
+
+        # 获取控制台输出期间记录可能已由构建事件结束，认领失败时跳过
+        if test_result is not None:
+            finished.append(rcd)
+
+    db.session.commit()
+    current_app.logger.info(f'checked {len(tasks)} tasks, finished {len(finished)} records')
+
+    for rcd in finished:
+        post_finalize(rcd)
+
+
+def migration_keys(project_id):
+    """项目修改测试服务器的进度及各任务的迁移状态在redis中的键，均以hash存放。"""
+    return f'migration:{project_id}', f'migration:{project_id}:jobs'
+
+
+def _migration_heartbeat(project_id, state=None):
+    """记录迁移的进展时间，同时可修改迁移状态。"""
+    progress, _ = migration_keys(project_id)
+    fields = {'heartbeat': time.time()}
+    if state:
+        fields['state'] = state
+    r.hmset(progress, fields)
+
+
+@contextmanager
+def _migration_guard(project_id):
+    """检查并修改项目的迁移状态期间持有的锁，同一项目的并发请求中只有一个能取得。
+
+    :return: 是否取得锁
+    """
+    guard, token = f'migration:{project_id}:guard', uuid.uuid4().hex
+    acquired = r.set(guard, token, ex=MIGRATION_GUARD_TIMEOUT, nx=True)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            _release_lock(keys=[guard], args=[token])
+
+
+def start_migration(project, server):
+    """开始将项目的全部任务迁移到新的测试服务器，由migrate_project_server在后台执行。
+
+    全部任务迁移成功后才修改项目的测试服务器；部分失败时可以继续迁移或回滚已迁移的任务。
+
+    :param project: 项目
+    :type project: Project
+    :param server: 新的测试服务器
+    :type server: Server
+    :return: 是否开始迁移，已有迁移或回滚在进行中时为False
+    """
+    progress, jobs = migration_keys(project.id)
+
+    with _migration_guard(project.id) as acquired:
+        if not acquired:
+            return False
+        state = migration_state(project.id)
+        if state and state['state'] in ('running', 'rolling_back'):
+            return False
+
+        pipe = r.pipeline()
+        pipe.delete(progress, jobs)
+        pipe.hmset(progress, {'server_id': server.id, 'state': 'running', 'heartbeat': time.time()})
+        pipe.expire(progress, MIGRATION_EXPIRE)
+        pipe.execute()
+
+    migrate_project_server.delay(project.id)
+    return True
+
+
+def _restart_migration(project_id, state):
+    """将部分失败的迁移改为state，返回是否修改成功，迁移不是部分失败或已有并发请求修改时为False。"""
+    with _migration_guard(project_id) as acquired:
+        if not acquired:
+            return False
+        current = migration_state(project_id)
+        if current is None or current['state'] != 'failed':
+            return False
+        _migration_heartbeat(project_id, state)
+    return True
+
+
+def continue_migration(project_id):
+    """继续部分失败的迁移，已迁移成功的任务不再重复迁移。
+
+    :return: 是否继续迁移
+    """
+    if not _restart_migration(project_id, 'running'):
+        return False
+    migrate_project_server.delay(project_id)
+    return True
+
+
+def start_rollback(project_id):
+    """回滚部分失败的迁移中已迁移的任务。
+
+    :return: 是否开始回滚
+    """
+    if not _restart_migration(project_id, 'rolling_back'):
+        return False
+    rollback_project_server.delay(project_id)
+    return True
+
+
+def migration_state(project_id):
+    """项目修改测试服务器的进度。
+
+    迁移中或回滚中超过MIGRATION_LEASE秒没有进展时（执行的worker已退出），按部分任务失败返回，可以继续或回滚。
+
+    :return: 没有进行过迁移时返回None，否则返回由目标服务器id、状态（running：迁移中，done：已完成，
+             failed：部分任务失败，rolling_back：回滚中，rolled_back：已回滚）、任务总数、已迁移数、失败数
+             及各任务状态（done：已迁移，rolled_back：已回滚，failed: 错误信息）组成的字典
+    """
+    progress, jobs = migration_keys(project_id)
+
+    pipe = r.pipeline()
+    pipe.hgetall(progress)
+    pipe.hgetall(jobs)
+    progress, jobs = pipe.execute()
+    if not progress:
+        return None
+
+    jobs = {name.decode('utf-8'): status.decode('utf-8') for name, status in jobs.items()}
+    state = progress[b'state'].decode('utf-8')
+    if state in ('running', 'rolling_back') and time.time() - float(progress.get(b'heartbeat', 0)) > MIGRATION_LEASE:
+        current_app.logger.warning(f'migration of project {project_id} is stale')
+        state = 'failed'
+
+    return {
+        'server_id': int(progress[b'server_id']),
+        'state': state,
+        'total': Task.query.filter_by(project_id=project_id).count(),
+        'done': sum(1 for status in jobs.values() if status == 'done'),
+        'failed': sum(1 for status in jobs.values() if status.startswith('failed')),
+        'jobs': jobs
+    }
+
+
+def _reconfigure_nodes(project_id, host, names, status):
+    """在有界线程池中并发修改任务的执行节点，每个任务完成后立即记录其状态。
+
+    :param host: 新的执行节点
+    :param names: 任务名列表
+    :param status: 修改成功时记录的状态
+    """
+    progress, jobs = migration_keys(project_id)
+    tasks = {t.name: t for t in Task.query.options(db.undefer('job_config')).filter(
+        Task.project_id == project_id, Task.name.in_(names))}
+    configs = {name: t.job_config for name, t in tasks.items()}
+
+    def reconfigure(name):
+        # 旧任务没有保存配置，从jenkins读取
+        config = set_node(configs[name] or jenkins.get_job_config(name), host)
+        reconfig_job(name, config)
+        r.hset(jobs, name, status)
+        r.hset(progress, 'heartbeat', time.time())
+        return config
+
+    for name, config in _poll(reconfigure, list(tasks), current_app.config['POLARIS_MIGRATION_WORKERS']).items():
+        if isinstance(config, JenkinsException):
+            current_app.logger.error(f'reconfigure node of {name} error: {config}')
+            r.hset(jobs, name, f'failed: {config}')
+        else:
+            tasks[name].job_config = config
+            tasks[name].job_config_hash = config_hash(config)
+
+    r.expire(jobs, MIGRATION_EXPIRE)
+    db.session.commit()
+
+
+@celery_app.task(name='app.celery_tasks.migrate_project_server')
+def migrate_project_server(project_id):
+    """将项目中尚未迁移的任务迁移到目标测试服务器，全部成功后修改项目的测试服务器，可重复执行以继续失败的迁移。
+
+    :param project_id: 项目id
+    :type project_id: int
+    """
+    state = migration_state(project_id)
+    if state is None:
+        return
+
+    _migration_heartbeat(project_id, 'running')
+
+    server = Server.query.get(state['server_id'])
+    names = [name for name, in db.session.query(Task.name).filter_by(project_id=project_id)
+             if state['jobs'].get(name) != 'done']
+    _reconfigure_nodes(project_id, server.host, names, 'done')
+
+    state = migration_state(project_id)
+    if state['done'] == state['total']:
+        p = Project.query.get(project_id)
+        p.server = server
+        db.session.commit()
+        _migration_heartbeat(project_id, 'done')
+
+        current_app.logger.info(f'migrated {state["total"]} tasks of {p} to {server}')
+    else:
+        _migration_heartbeat(project_id, 'failed')
+
+        current_app.logger.error(f'migrated {state["done"]}/{state["total"]} tasks of project {project_id}')
+
+
+@celery_app.task(name='app.celery_tasks.rollback_project_server')
+def rollback_project_server(project_id):
+    """将失败的迁移中已迁移的任务改回项目当前的测试服务器。
+
+    :param project_id: 项目id
+    :type project_id: int
+    """
+    # 由start_rollback改为回滚中后执行
+    state = migration_state(project_id)
+    if state is None or state['state'] not in ('failed', 'rolling_back'):
+        return
+
+    _migration_heartbeat(project_id, 'rolling_back')
+
+    names = [name for name, status in state['jobs'].items() if status == 'done']
+    _reconfigure_nodes(project_id, Project.query.get(project_id).server.host, names, 'rolled_back')
+
+    state = migration_state(project_id)
+    _migration_heartbeat(project_id, 'failed' if state['done'] else 'rolled_back')
+
+
+def _node_state(node):
+    """将jenkins节点数据转为测试服务器状态，state为1：在线，0：离线，-1：jenkins中不存在该节点。"""
+    if node is None:
+        return {'state': -1, 'os': '', 'disk_space': ''}
+    if node['offline']:
+        return {'state': 0, 'os': '', 'disk_space': ''}
+
+    monitor_data = node.get('monitorData') or {}
+    disk_space = monitor_data.get('hudson.node_monitors.DiskSpaceMonitor') or {}
+    return {
+        'state': 1,
+        'os': monitor_data.get('hudson.node_monitors.ArchitectureMonitor') or '',
+        'disk_space': round(disk_space['size'] / 1024 / 1024 / 1024, 2) if disk_space.get('size') else ''
+    }
+
+
+@celery_app.task(name='app.celery_tasks.collect_nodes')
+def collect_nodes():
+    """通过一次请求获取全部测试服务器的状态并写入redis快照，服务器的工作目录或描述变化时才写入数据库。
+
+    快照写入后，为恢复在线的服务器以及队列中仍有等待记录的在线服务器派发等待执行的记录，
+    每个服务器一个派发任务，并发数受celery worker数限制，同一服务器内按队列顺序派发。
+    """
+    try:
+        nodes = {node['displayName']: node for node in get_nodes()}
+    except JenkinsException as e:
+        current_app.logger.error('jenkins get nodes error')
+        current_app.logger.exception(e)
+        return
+
+    servers = Server.query.all()
+    previous = dict(zip([s.host for s in servers], node_states([s.host for s in servers])))
+
+    snapshot = {}
+    recovered = set()
+    for s in servers:
+        node = nodes.get(s.host)
+        state = _node_state(node)
+        snapshot[s.host] = json.dumps(state)
+
+        if state['state'] == 1 and previous[s.host]['state'] != 1:
+            current_app.logger.info(f'{s} online')
+            recovered.add(s.id)
+
+        if state['state'] == 1:
+            workspace = (node['monitorData'].get('hudson.node_monitors.DiskSpaceMonitor') or {}).get('path')
+            if workspace and s.workspace != workspace:
+                s.workspace = workspace
+            if s.info != node['description']:
+                s.info = node['description']
+
+    if db.session.dirty:
+        current_app.logger.info(f'updated servers: {db.session.dirty}')
+        db.session.commit()
+
+    pipe = r.pipeline()
+    pipe.delete(NODE_SNAPSHOT)
+    if snapshot:
+        pipe.hmset(NODE_SNAPSHOT, snapshot)
+        pipe.expire(NODE_SNAPSHOT, NODE_SNAPSHOT_EXPIRE)
+    pipe.execute()
+
+    # 快照写入后再派发，派发时按新快照判断服务器在线
+    online = {s.id for s in servers if json.loads(snapshot[s.host])['state'] == 1}
+    waiting = {server_id for server_id, in db.session.query(Project.server_id).join(
+        Record, Record.project_id == Project.id).filter(Record.state == -2).distinct()}
+    for server_id in recovered | (online & waiting):
+        dispatch_records.delay(server_id)
+
+
+def node_states(hosts):
+    """从快照中读取测试服务器的状态。
+
+    :param hosts: 服务器地址列表
+    :type hosts: list
+    :return: 与hosts一一对应的状态字典列表，快照中没有的服务器或快照已过期时state为None
+    """
+    if not hosts:
+        return []
+    return [json.loads(value.decode('utf-8')) if value else {'state': None, 'os': '', 'disk_space': ''}
+            for value in r.hmget(NODE_SNAPSHOT, hosts)]
+
+
+def server_online(server):
+    """测试服务器是否在线，优先读取后台采集的快照。"""
+    state = node_states([server.host])[0]['state']
+    if state is None:
+        try:
+            state = 0 if get_node_info(server.host)['offline'] else 1
+        except JenkinsException:
+            state = -1
+    return state == 1
+
+
+def dispatch_server(server_id):
+    """将服务器队列中的记录派发到jenkins，直到没有空闲执行器；同一服务器同时只有一个派发过程，
+    派发过程中有新的派发请求时，本次派发结束后重新检查队列。
+
+    :param server_id: 测试服务器id
+    :type server_id: int
+    :return: 本次派发的记录列表
+    """
+    lock, again = f'dispatch:lock:{server_id}', f'dispatch:again:{server_id}'
+    token = uuid.uuid4().hex
+    if not r.set(lock, token, ex=DISPATCH_LOCK_TIMEOUT, nx=True):
+        r.set(again, 1, ex=DISPATCH_LOCK_TIMEOUT)
+        return []
+
+    dispatched = []
+    try:
+        while True:
+            r.delete(again)
+
+            server = Server.query.get(server_id)
+            if server is None or not server_online(server):
+                break
+
+            for rcd in next_records(server):
+                try:
+                    # 构建号在构建开始执行时才确定，由check_dispatched、构建事件或定时检查根据队列项id补上
+                    queue_id = queue_build(rcd.task.name)
+                except JenkinsException as e:
+                    current_app.logger.error(f'dispatch {rcd} error')
+                    current_app.logger.exception(e)
+                    return dispatched
+
+                rcd.queue_id = queue_id
+                rcd.dispatched_at = datetime.utcnow()
+                # 旧版本的等待记录带有猜测的构建号，清除后按队列项id确定，避免与实际使用该构建号的构建混淆
+                rcd.build_number = None
+                rcd.state = 0
+                db.session.commit()
+
+                dispatched.append(rcd)
+                current_app.logger.info(f'dispatched record: {rcd}, queue item {queue_id}')
+
+                if not _extend_lock(keys=[lock], args=[token, DISPATCH_LOCK_TIMEOUT]):
+                    # 锁已过期并可能被其他进程取得，停止本次派发
+                    current_app.logger.warning(f'dispatch lock of server {server_id} lost')
+                    return dispatched
+
+            if not r.get(again):
+                break
+    finally:
+        _release_lock(keys=[lock], args=[token])
+
+    return dispatched
+
+
+@celery_app.task(name='app.celery_tasks.dispatch_records')
+def dispatch_records(server_id):
+    """派发测试服务器队列中等待执行的记录。
+
+    :param server_id: 测试服务器id
+    :type server_id: int
+    """
+    dispatch_server(server_id)
+
+
+def _requeue(rcd):
+    """已派发的记录回到等待队列，下次派发时重新触发构建。"""
+    rcd.state = -2
+    rcd.queue_id = None
+    rcd.dispatched_at = None
+
+
+@celery_app.task(name='app.celery_tasks.check_dispatched')
+def check_dispatched():
+    """检查已派发到jenkins、尚未确定构建号的记录。
+
+    构建开始执行后从队列项中取得构建号；队列项被取消，或超过POLARIS_DISPATCH_START_TIMEOUT秒仍未开始执行
+    （如节点离线），取消队列项后记录回到等待队列，不再一直占用服务器的执行器和任务。
+    """
+    records = Record.query.filter(Record.state == 0, Record.build_number.is_(None),
+                                  Record.queue_id.isnot(None)).all()
+    if not records:
+        return
+
+    deadline = datetime.utcnow() - timedelta(seconds=current_app.config['POLARIS_DISPATCH_START_TIMEOUT'])
+    items = _poll(get_queue_item, [rcd.queue_id for rcd in records])
+
+    requeued, expired = [], []
+    for rcd in records:
+        item = items[rcd.queue_id]
+        if isinstance(item, NotFoundException):
+            # jenkins只保留已开始执行的队列项几分钟，之后由构建事件或定时检查根据构建的队列项id确定构建号；
+            # jenkins重启后排队的构建也会丢失，超时后重新派发
+            if rcd.dispatched_at < deadline:
+                requeued.append(rcd)
+        elif isinstance(item, JenkinsException):
+            current_app.logger.error(f'get queue item of {rcd} error', exc_info=item)
+        elif item.get('executable'):
+            rcd.build_number = item['executable']['number']
+        elif item.get('cancelled'):
+            requeued.append(rcd)
+        elif rcd.dispatched_at < deadline:
+            expired.append(rcd)
+
+    if expired:
+        _poll(cancel_queue_item, [rcd.queue_id for rcd in expired])
+        # 取消前构建可能已开始执行，重新查询一次
+        items = _poll(get_queue_item, [rcd.queue_id for rcd in expired])
+        for rcd in expired:
+            item = items[rcd.queue_id]
+            if isinstance(item, JenkinsException) and not isinstance(item, NotFoundException):
+                current_app.logger.error(f'cancel queue item of {rcd} error', exc_info=item)
+            elif not isinstance(item, JenkinsException) and item.get('executable'):
+                rcd.build_number = item['executable']['number']
+            else:
+                requeued.append(rcd)
+
+    for rcd in requeued:
+        current_app.logger.warning(f'dispatched record not started, requeue: {rcd}')
+        _requeue(rcd)
+    db.session.commit()
+
+    for server_id in {rcd.project.server_id for rcd in requeued}:
+        dispatch_records.delay(server_id)
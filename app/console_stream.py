@@ -0,0 +1,139 @@
+# coding=utf-8
+
+"""
+构建控制台输出的共享订阅。
+
+每个（任务，构建号）只有一个后台线程从jenkins增量读取控制台输出，并通过redis的发布订阅分发给所有查看者，
+jenkins的请求量与查看人数无关。后台线程在第一个查看者订阅时启动，在查看者全部离开或构建结束后退出；
+线程所在进程退出后锁自动过期，由其他查看者的进程重新启动。
+"""
+
+import json
+import time
+import uuid
+import threading
+
+import redis
+from flask import current_app
+from jenkins import JenkinsException
+
+from .jenkins_api import get_progressive_text
+
+r = redis.Redis('localhost')
+
+POLL_INTERVAL = 1  # 读取jenkins的间隔（秒）
+LOCK_TIMEOUT = 10  # 后台线程锁的过期时间（秒）
+VIEWER_TIMEOUT = 30  # 查看者心跳的过期时间（秒）
+
+
+def _keys(task_name, build_number):
+    suffix = f'{task_name}:{build_number}'
+    return f'console:channel:{suffix}', f'console:viewers:{suffix}', f'console:tailer:{suffix}'
+
+
+def _tail(app, task_name, build_number, token):
+    """后台线程，读取jenkins控制台输出的新内容并发布到频道中。"""
+    channel, viewers, lock = _keys(task_name, build_number)
+    start = 0
+
+    with app.app_context():
+        while True:
+            # 锁已过期并被其他进程获取时退出
+            if r.get(lock) != token.encode('utf-8'):
+                return
+            r.expire(lock, LOCK_TIMEOUT)
+
+            if not r.zcount(viewers, time.time() - VIEWER_TIMEOUT, '+inf'):
+                current_app.logger.debug(f'no viewer of {task_name} #{build_number}, stop tailing')
+                break
+
+            try:
+                text, end, more_data = get_progressive_text(task_name, build_number, start)
+            except JenkinsException as e:
+                current_app.logger.error('connect Jenkins error')
+                current_app.logger.exception(e)
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            if text or not more_data:
+                r.publish(channel, json.dumps({'start': start, 'end': end, 'text': text, 'more': more_data}))
+            start = end
+
+            if not more_data:
+                current_app.logger.debug(f'{task_name} #{build_number} ended, stop tailing')
+                break
+
+            time.sleep(POLL_INTERVAL)
+
+        if r.get(lock) == token.encode('utf-8'):
+            r.delete(lock)
+
+
+def _ensure_tailer(task_name, build_number):
+    """构建没有后台线程时启动一个。"""
+    _, _, lock = _keys(task_name, build_number)
+    token = uuid.uuid4().hex
+
+    if r.set(lock, token, ex=LOCK_TIMEOUT, nx=True):
+        current_app.logger.debug(f'start tailing {task_name} #{build_number}')
+        threading.Thread(target=_tail, args=(current_app._get_current_object(), task_name, build_number, token),
+                         daemon=True).start()
+
+
+def subscribe(task_name, build_number, start=0):
+    """订阅构建的控制台输出。
+
+    :param task_name: 任务名
+    :type task_name: str
+    :param build_number: 构建号
+    :type build_number: int
+    :param start: 查看者已读取的字节数
+    :type start: int
+    :return: 生成器，依次产生新增的输出、下次读取的偏移、构建是否结束组成的元组，构建结束后停止
+    """
+    channel, viewers, _ = _keys(task_name, build_number)
+    viewer = uuid.uuid4().hex
+
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(channel)
+    try:
+        r.zadd(viewers, viewer, time.time())
+        _ensure_tailer(task_name, build_number)
+
+        # 先订阅再补齐已有的输出，之后频道中与已读部分重叠的内容按偏移截掉
+        text, start, more_data = get_progressive_text(task_name, build_number, start)
+        yield text, start, not more_data
+        if not more_data:
+            return
+
+        while True:
+            message = pubsub.get_message(timeout=POLL_INTERVAL)
+
+            r.zadd(viewers, viewer, time.time())
+            r.expire(viewers, VIEWER_TIMEOUT)
+            _ensure_tailer(task_name, build_number)
+
+            if message is None:
+                yield '', start, False
+                continue
+
+            chunk = json.loads(message['data'].decode('utf-8'))
+            if chunk['start'] > start:
+                # 中间有未收到的内容，直接从jenkins补齐
+                text, start, more_data = get_progressive_text(task_name, build_number, start)
+                yield text, start, not more_data
+                if not more_data:
+                    return
+                continue
+
+            if chunk['end'] > start:
+                text = chunk['text'].encode('utf-8')[start - chunk['start']:].decode('utf-8', errors='ignore')
+                start = chunk['end']
+                yield text, start, False
+
+            if not chunk['more']:
+                yield '', start, True
+                return
+    finally:
+        r.zrem(viewers, viewer)
+        pubsub.close()
@@ -0,0 +1,78 @@
+# coding=utf-8
+
+"""
+执行请求的派发队列。
+
+执行请求先作为等待执行（state为-2）的执行记录加入所在测试服务器的队列，测试服务器有空闲执行器时再触发jenkins构建，
+jenkins中不会堆积排队的构建。队列按优先级从高到低派发，同一优先级内轮流派发各项目的请求：
+每次选择在该服务器上执行中（含本轮已选中）的记录最少的项目，项目相同时先到先派发。
+旧版本直接提交到jenkins排队的等待记录带有预先猜测的构建号，与其他等待记录一样派发，派发时清除该构建号。
+"""
+
+from collections import Counter
+
+from . import db
+from .models import Record, Project, Server
+
+PRIORITIES = {0: '普通', 1: '优先'}
+
+
+def _running(server_id):
+    """服务器上执行中的记录的项目id和任务id。"""
+    return db.session.query(Record.project_id, Record.task_id).join(Project, Record.project_id == Project.id).filter(
+        Project.server_id == server_id, Record.state == 0).all()
+
+
+def queue(server_id):
+    """服务器的等待队列。
+
+    :param server_id: 测试服务器id
+    :type server_id: int
+    :return: 按派发顺序排列的等待执行的记录列表
+    """
+    waiting = Record.query.options(db.joinedload('task')).join(Project, Record.project_id == Project.id).filter(
+        Project.server_id == server_id, Record.state == -2).order_by(
+        Record.priority.desc(), Record.id).all()
+    running = Counter(project_id for project_id, _ in _running(server_id))
+
+    ordered = []
+    while waiting:
+        top = waiting[0].priority
+        rcd = min((rcd for rcd in waiting if rcd.priority == top), key=lambda rcd: (running[rcd.project_id], rcd.id))
+        running[rcd.project_id] += 1
+        waiting.remove(rcd)
+        ordered.append(rcd)
+    return ordered
+
+
+def next_records(server, limit=None):
+    """服务器当前可以派发的记录。
+
+    :param server: 测试服务器
+    :type server: Server
+    :param limit: 最多派发的数量，默认为服务器的空闲执行器数
+    :type limit: int
+    :return: 按派发顺序排列的记录列表，同一任务同时只会执行一个构建，已有执行中构建的任务跳过
+    """
+    running = _running(server.id)
+    if limit is None:
+        limit = (server.executors or Server.DEFAULT_EXECUTORS) - len(running)
+    busy_tasks = {task_id for _, task_id in running}
+
+    records = []
+    for rcd in queue(server.id):
+        if len(records) >= limit:
+            break
+        if rcd.task_id in busy_tasks:
+            continue
+        busy_tasks.add(rcd.task_id)
+        records.append(rcd)
+    return records
+
+
+def positions(server_id):
+    """服务器等待队列中各记录的位置。
+
+    :return: 记录id到其前面等待的记录数的字典
+    """
+    return {rcd.id: i for i, rcd in enumerate(queue(server_id))}
@@ -0,0 +1,264 @@
+# coding=utf-8
+
+"""
+flask_jenkins未提供的jenkins REST接口，通过tree参数只取需要的字段；以及构建信息、节点信息查询的redis缓存。
+
+缓存由各进程共享，同一对象并发未命中时只有一个进程请求jenkins，其他进程等待其结果；
+收到构建事件后该构建的缓存立即失效，通过本模块修改节点配置后该节点的缓存立即失效。
+缓存只用于构建事件缺少结果时查询构建信息，以及服务器状态快照缺失时查询节点信息；
+定时检查（check_state、collect_nodes）每次都需要最新状态，直接以tree参数批量请求，不经过缓存。
+"""
+
+import json
+import time
+from urllib.parse import quote
+
+import redis
+import requests
+from flask import current_app
+from jenkins import JenkinsException, NotFoundException
+
+from . import jenkins
+
+r = redis.Redis('localhost')
+
+CACHE_STATS = 'jenkins:cache:stats'  # 各接口的命中、未命中、等待其他进程结果的次数
+CACHE_LOCK_TIMEOUT = 10  # 请求jenkins的锁的过期时间（秒），超过时不再等待，直接请求
+CACHE_WAIT_INTERVAL = 0.05  # 等待其他进程请求结果的轮询间隔（秒）
+
+
+def _get(path, **params):
+    """请求jenkins接口。
+
+    :param path: 接口路径，不含开头的'/'
+    :param params: 查询参数
+    :return: requests的Response
+    """
+    url = 'http://{}:{}@{}/{}'.format(current_app.config['JENKINS_USERNAME'], current_app.config['JENKINS_PASSWORD'],
+                                      current_app.config['JENKINS_HOST'], path)
+    try:
+        response = requests.get(url, params=params, timeout=30)
+        if response.status_code == 404:
+            raise NotFoundException(f'{path} not found')
+        response.raise_for_status()
+        return response
+    except requests.exceptions.RequestException as e:
+        raise JenkinsException(f'get {path} error: {e}') from e
+
+
+def _post(path, **params):
+    """以POST请求jenkins接口，jenkins开启了CSRF保护时先在同一会话中获取crumb。
+
+    :param path: 接口路径，不含开头的'/'
+    :param params: 查询参数
+    :return: requests的Response
+    """
+    url = 'http://{}/'.format(current_app.config['JENKINS_HOST'])
+    try:
+        with requests.Session() as session:
+            session.auth = (current_app.config['JENKINS_USERNAME'], current_app.config['JENKINS_PASSWORD'])
+
+            headers = {}
+            crumb = session.get(url + 'crumbIssuer/api/json', timeout=30)
+            if crumb.status_code == 200:
+                crumb = crumb.json()
+                headers[crumb['crumbRequestField']] = crumb['crumb']
+
+            response = session.post(url + path, params=params, headers=headers, timeout=30)
+            if response.status_code == 404:
+                raise NotFoundException(f'{path} not found')
+            response.raise_for_status()
+            return response
+    except requests.exceptions.RequestException as e:
+        raise JenkinsException(f'post {path} error: {e}') from e
+
+
+def _get_json(path, **params):
+    """请求jenkins的json接口，返回解析后的json数据。"""
+    return _get(path, **params).json()
+
+
+def get_builds(name, since=0, page_size=50):
+    """获取任务中构建号大于since的构建。
+
+    jenkins按构建号倒序返回构建列表，按页读取直到遇到不大于since的构建为止，因此请求次数只与新构建数量有关。
+
+    :param name: 任务名
+    :type name: str
+    :param since: 已同步的构建号，只返回比它新的构建
+    :type since: int
+    :param page_size: 每次请求的构建数量
+    :type page_size: int
+    :return: 由构建号、结果（执行中为None）、耗时（毫秒）、队列项id组成的字典列表，按构建号升序排列
+    """
+    builds = []
+    start = 0
+    while True:
+        tree = f'builds[number,result,duration,queueId]{{{start},{start + page_size}}}'
+        page = _get_json(f'job/{quote(name)}/api/json', tree=tree)['builds']
+        builds.extend(build for build in page if build['number'] > since)
+
+        if len(page) < page_size or page[-1]['number'] <= since:
+            return builds[::-1]
+        start += page_size
+
+
+def get_nodes():
+    """一次请求获取jenkins全部节点的状态。
+
+    :return: 由节点名（测试服务器地址）、描述、是否离线、监控数据（平台、磁盘空间等）组成的字典列表
+    """
+    tree = 'computer[displayName,description,offline,monitorData[*[path,size]]]'
+    return _get_json('computer/api/json', tree=tree)['computer']
+
+
+def get_progressive_text(name, number, start=0):
+    """从指定字节偏移处读取构建的控制台输出。
+
+    :param name: 任务名
+    :type name: str
+    :param number: 构建号
+    :type number: int
+    :param start: 已读取的字节数
+    :type start: int
+    :return: 新增的输出、下次读取的偏移、构建是否仍在输出组成的元组
+    """
+    response = _get(f'job/{quote(name)}/{number}/logText/progressiveText', start=start)
+    data = response.content
+    end = int(response.headers.get('X-Text-Size', start + len(data)))
+    more_data = response.headers.get('X-More-Data') == 'true'
+
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError as e:
+        if more_data and e.reason == 'unexpected end of data':
+            # 末尾被截断的多字节字符留到下次读取
+            end -= len(data) - e.start
+            data = data[:e.start]
+        text = data.decode('utf-8', errors='replace')
+
+    return text, end, more_data
+
+
+def _cache_key(method, *args):
+    return 'jenkins:cache:{}:{}'.format(method, ':'.join(str(arg) for arg in args))
+
+
+def _cached(method, args, fetch, ttl):
+    """读取缓存，未命中时请求jenkins并写入缓存。
+
+    :param method: 接口名，用于缓存的键和统计
+    :param args: 区分缓存对象的参数
+    :param fetch: 请求jenkins的调用
+    :param ttl: 缓存时间（秒）
+    """
+    key = _cache_key(method, *args)
+    value = r.get(key)
+    if value is not None:
+        r.hincrby(CACHE_STATS, f'{method}:hit')
+        return json.loads(value.decode('utf-8'))
+
+    # 其他进程正在请求时等待其结果
+    lock = f'{key}:lock'
+    deadline = time.time() + CACHE_LOCK_TIMEOUT
+    locked = r.set(lock, 1, ex=CACHE_LOCK_TIMEOUT, nx=True)
+    while not locked and time.time() < deadline:
+        time.sleep(CACHE_WAIT_INTERVAL)
+        value = r.get(key)
+        if value is not None:
+            r.hincrby(CACHE_STATS, f'{method}:coalesced')
+            return json.loads(value.decode('utf-8'))
+        locked = r.set(lock, 1, ex=CACHE_LOCK_TIMEOUT, nx=True)
+
+    r.hincrby(CACHE_STATS, f'{method}:miss')
+    try:
+        value = fetch()
+        r.set(key, json.dumps(value), ex=ttl(value) if callable(ttl) else ttl)
+        return value
+    finally:
+        if locked:
+            r.delete(lock)
+
+
+def get_build_info(name, number):
+    """获取构建信息，执行中的构建缓存POLARIS_JENKINS_CACHE_TTL['build']秒，已结束的构建不再变化，缓存时间更长。"""
+    ttls = current_app.config['POLARIS_JENKINS_CACHE_TTL']
+    return _cached('get_build_info', (name, number), lambda: jenkins.get_build_info(name, number),
+                   lambda info: ttls['finished_build'] if info.get('result') else ttls['build'])
+
+
+def get_node_info(host):
+    """获取节点信息，缓存POLARIS_JENKINS_CACHE_TTL['node']秒。"""
+    return _cached('get_node_info', (host,), lambda: jenkins.get_node_info(host),
+                   current_app.config['POLARIS_JENKINS_CACHE_TTL']['node'])
+
+
+def invalidate_build(name, number):
+    """使构建信息的缓存失效。"""
+    r.delete(_cache_key('get_build_info', name, number))
+
+
+def invalidate_node(host):
+    """使节点信息的缓存失效。"""
+    r.delete(_cache_key('get_node_info', host))
+
+
+def queue_build(name):
+    """触发构建。构建号在构建开始执行时才确定，通过返回的队列项id查询；python-jenkins的build_job不返回队列项id。
+
+    :param name: 任务名
+    :type name: str
+    :return: jenkins队列项id
+    """
+    response = _post(f'job/{quote(name)}/build')
+
+    # Location为http://jenkins/queue/item/<id>/
+    location = response.headers.get('Location', '').rstrip('/')
+    try:
+        return int(location.rsplit('/', 1)[1])
+    except (IndexError, ValueError):
+        raise JenkinsException(f'build {name} without queue item: {location}')
+
+
+def get_queue_item(queue_id):
+    """获取队列项状态，不缓存；构建开始后jenkins只在一段时间内保留队列项，之后抛出NotFoundException。
+
+    :param queue_id: 队列项id
+    :type queue_id: int
+    :return: 由是否已取消、开始执行的构建（未开始时没有该字段）组成的字典
+    """
+    return _get_json(f'queue/item/{queue_id}/api/json', tree='cancelled,executable[number]')
+
+
+def cancel_queue_item(queue_id):
+    """取消排队中的构建，构建已开始执行时没有影响。"""
+    _post('queue/cancelItem', id=queue_id)
+
+
+def reconfig_job(name, config):
+    """修改任务配置。"""
+    jenkins.reconfig_job(name, config)
+
+
+def reconfig_node(host, config):
+    """修改节点配置。"""
+    jenkins.reconfig_node(host, config)
+    invalidate_node(host)
+
+
+def enable_node(host):
+    """启用节点。"""
+    jenkins.enable_node(host)
+    invalidate_node(host)
+
+
+def cache_stats():
+    """各接口缓存的命中情况。
+
+    :return: 接口名到命中、未命中、等待其他进程结果次数组成的字典的字典
+    """
+    stats = {}
+    for field, count in r.hgetall(CACHE_STATS).items():
+        method, kind = field.decode('utf-8').rsplit(':', 1)
+        stats.setdefault(method, {'hit': 0, 'miss': 0, 'coalesced': 0})[kind] = int(count)
+    return stats
@@ -1,5 +1,5 @@
 """
-deprecated.
+deprecated, 用例结果解析使用junit.iter_cases。
 """
 
 
@@ -0,0 +1,56 @@
+# coding=utf-8
+
+"""
+JUnit/nose XML测试报告的流式解析，逐个用例产生结果并释放已解析的元素，内存占用与报告大小无关。
+"""
+
+from lxml import etree
+
+PASSED = 0
+FAILURE = 1
+ERROR = 2
+SKIPPED = 3
+
+
+def iter_cases(fp):
+    """逐个解析测试报告中的用例。
+
+    :param fp: 以二进制方式打开的报告文件
+    :return: 生成器，依次产生由suite、classname、name、status、time、message组成的字典
+    """
+    suites = []
+
+    for event, elem in etree.iterparse(fp, events=('start', 'end'), huge_tree=True):
+        if event == 'start':
+            if elem.tag == 'testsuite':
+                suites.append(elem.get('name', ''))
+            continue
+
+        if elem.tag == 'testcase':
+            status = PASSED
+            message = None
+            for child in elem:
+                if child.tag == 'failure':
+                    status, message = FAILURE, child.get('message')
+                elif child.tag == 'error':
+                    status, message = ERROR, child.get('message')
+                elif child.tag == 'skipped':
+                    status, message = SKIPPED, child.get('message')
+
+            yield {
+                'suite': suites[-1] if suites else '',
+                'classname': elem.get('classname', ''),
+                'name': elem.get('name', ''),
+                'status': status,
+                'time': float(elem.get('time') or 0),
+                'message': message
+            }
+        elif elem.tag == 'testsuite':
+            suites.pop()
+        else:
+            continue
+
+        # 释放已解析的用例及之前的兄弟节点
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
@@ -0,0 +1,138 @@
+# coding=utf-8
+
+"""
+jenkins任务配置的生成。
+
+配置由预先编译的模板生成，各参数填入前做xml转义；生成的配置及其摘要保存在任务中，
+修改任务时与上次应用的配置比较，只有内容变化时才需要更新jenkins。
+"""
+
+import re
+import hashlib
+from string import Template
+from xml.sax.saxutils import escape
+
+from flask import current_app, url_for
+
+JOB_TEMPLATE = Template('''<project>
+  <actions />
+  <description>${description}</description>
+  <keepDependencies>false</keepDependencies>
+  <properties>${notification}</properties>
+  <scm class="hudson.scm.NullSCM" />
+  <assignedNode>${node}</assignedNode>
+  <canRoam>false</canRoam>
+  <disabled>false</disabled>
+  <blockBuildWhenDownstreamBuilding>false</blockBuildWhenDownstreamBuilding>
+  <blockBuildWhenUpstreamBuilding>false</blockBuildWhenUpstreamBuilding>
+  <triggers>${trigger}</triggers>
+  <concurrentBuild>false</concurrentBuild>
+  <builders>
+    <hudson.tasks.Shell>
+      <command>${command}</command>
+    </hudson.tasks.Shell>
+  </builders>
+  <publishers>
+    <org.jenkinsci.plugins.postbuildscript.PostBuildScript plugin="postbuildscript@2.7.0">
+      <config>
+        <scriptFiles />
+        <groovyScripts />
+        <buildSteps>
+          <org.jenkinsci.plugins.postbuildscript.model.PostBuildStep>
+            <results>
+              <string>FAILURE</string>
+              <string>SUCCESS</string>
+            </results>
+            <role>BOTH</role>
+            <buildSteps>
+              <hudson.tasks.Shell>
+                <command>${post_build_script}</command>
+              </hudson.tasks.Shell>
+            </buildSteps>
+          </org.jenkinsci.plugins.postbuildscript.model.PostBuildStep>
+        </buildSteps>
+        <markBuildUnstable>false</markBuildUnstable>
+      </config>
+    </org.jenkinsci.plugins.postbuildscript.PostBuildScript>
+  </publishers>
+  <buildWrappers />
+</project>''')
+
+TRIGGER_TEMPLATE = Template('''
+    <hudson.triggers.TimerTrigger>
+      <spec>${cron}</spec>
+    </hudson.triggers.TimerTrigger>
+  ''')
+
+# 构建事件推送到平台的build_event接口，需要jenkins安装Notification插件
+NOTIFICATION_TEMPLATE = Template('''
+    <com.tikal.hudson.plugins.notification.HudsonNotificationProperty plugin="notification@1.13">
+      <endpoints>
+        <com.tikal.hudson.plugins.notification.Endpoint>
+          <protocol>HTTP</protocol>
+          <format>JSON</format>
+          <urlInfo>
+            <urlOrId>${url}</urlOrId>
+            <urlType>PUBLIC</urlType>
+          </urlInfo>
+          <event>all</event>
+          <timeout>30000</timeout>
+          <loglines>0</loglines>
+          <retries>3</retries>
+        </com.tikal.hudson.plugins.notification.Endpoint>
+      </endpoints>
+    </com.tikal.hudson.plugins.notification.HudsonNotificationProperty>
+  ''')
+
+
+def _text(value):
+    """转义为xml文本，并去掉表单提交带来的回车符。"""
+    return escape((value or '').replace('\r', ''))
+
+
+def _notification():
+    """生成构建事件推送配置，未配置POLARIS_URL时返回空字符串。"""
+    if not current_app.config['POLARIS_URL']:
+        return ''
+
+    url = current_app.config['POLARIS_URL'].rstrip('/') + url_for(
+        'record.build_event', token=current_app.config['POLARIS_BUILD_EVENT_TOKEN'])
+    return NOTIFICATION_TEMPLATE.substitute(url=_text(url))
+
+
+def render_job_config(description, node, command, post_build_script, cron=None):
+    """生成jenkins任务配置。
+
+    :param description: 任务说明
+    :type description: str
+    :param node: 执行任务的jenkins节点（测试服务器地址）
+    :type node: str
+    :param command: 测试命令
+    :type command: str
+    :param post_build_script: 构建结束后执行的结果统计命令
+    :type post_build_script: str
+    :param cron: 定时执行的crontab，为空时不定时执行
+    :type cron: str
+    :return: 任务配置xml
+    """
+    return JOB_TEMPLATE.substitute(description=_text(description), notification=_notification(), node=_text(node),
+                                   trigger=TRIGGER_TEMPLATE.substitute(cron=_text(cron)) if cron else '',
+                                   command=_text(command), post_build_script=_text(post_build_script))
+
+
+def set_node(config, node):
+    """替换任务配置中的执行节点，其他内容不变。
+
+    :param config: 任务配置xml
+    :type config: str
+    :param node: 新的执行节点（测试服务器地址）
+    :type node: str
+    :return: 替换后的任务配置xml
+    """
+    return re.sub(r'<assignedNode>.*?</assignedNode>|<assignedNode\s*/>',
+                  lambda _: f'<assignedNode>{_text(node)}</assignedNode>', config, count=1, flags=re.S)
+
+
+def config_hash(config):
+    """任务配置的摘要。"""
+    return hashlib.sha1(config.encode('utf-8')).hexdigest()
@@ -1,11 +1,15 @@
 # coding=utf-8
 
+import zlib
+import codecs
+import hashlib
 from datetime import datetime
 
 from flask import current_app
 from flask_login import UserMixin, AnonymousUserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from markdown import markdown
+from sqlalchemy.exc import IntegrityError
 import bleach
 
 from . import db, login_manager
@@ -186,6 +190,8 @@ class Server(db.Model):
     """测试服务器。"""
     __tablename__ = 'servers'
 
+    DEFAULT_EXECUTORS = 5  # 节点默认的执行器数量，也用于添加该字段前创建的服务器
+
     id = db.Column(db.Integer, primary_key=True)
     projects = db.relationship('Project', backref='server', lazy='dynamic')
     operating_records = db.relationship('OperatingRecord', backref='server', lazy='dynamic')
@@ -194,6 +200,7 @@ class Server(db.Model):
     password = db.Column(db.String(64))
     workspace = db.Column(db.String(64))
     info = db.Column(db.Text)
+    executors = db.Column(db.Integer, default=DEFAULT_EXECUTORS)  # jenkins节点的执行器数量，即可同时执行的任务数
 
     def __repr__(self):
         return f'<Server {self.id}, host {self.host}, info {self.info}>'
@@ -214,6 +221,7 @@ class Project(db.Model):
     name = db.Column(db.String(64), unique=True, index=True)
     info = db.Column(db.Text)
     allowed = db.Column(db.Boolean, default=False)  # 是否已经被批准创建
+    digest_window = db.Column(db.Integer, default=0)  # 汇总邮件窗口（分钟），窗口内结束的任务合并为一封邮件，0为不汇总
 
     @staticmethod
     def on_created(target, value, old_value, initiator):
@@ -249,6 +257,10 @@ class Task(db.Model):
     email_body = db.Column(db.Text)  # Markdown格式模板
     email_body_html = db.Column(db.Text)  # HTML格式模板
     email_attachments = db.Column(db.Text)
+    junit_report = db.Column(db.Text)  # JUnit XML格式测试报告在测试服务器上的路径
+    synced_build_number = db.Column(db.Integer, default=0)  # 同步水位，不大于该构建号的构建均已结束并入库
+    job_config = db.deferred(db.Column(db.Text))  # 最近一次应用到jenkins的任务配置
+    job_config_hash = db.Column(db.String(40))  # job_config的sha1摘要
 
     def __repr__(self):
         return f'<Task {self.id}, name {self.name}, info {self.info}, project {self.project_id}>'
@@ -270,9 +282,13 @@ class Record(db.Model):
     task_id = db.Column(db.Integer, db.ForeignKey('tasks.id'))
     project_id = db.Column(db.Integer, db.ForeignKey('projects.id'))
     result = db.relationship('Result', backref='record', uselist=False)
+    test_cases = db.relationship('TestCase', backref='record', lazy='dynamic')
     build_number = db.Column(db.Integer)  # jenkins的build number
     version = db.Column(db.String(64))
     state = db.Column(db.Integer, default=-2)  # -1：执行失败，0：执行中，1：执行成功，-2：等待执行
+    priority = db.Column(db.Integer, default=0)  # 等待执行时的派发优先级，越大越先派发
+    queue_id = db.Column(db.Integer, index=True)  # 派发到jenkins的队列项id，构建开始后据此确定构建号
+    dispatched_at = db.Column(db.DateTime)  # 派发到jenkins的时间
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
     def __repr__(self):
@@ -284,20 +300,308 @@ class Result(db.Model):
     """测试任务执行结果。"""
     __tablename__ = 'results'
 
+    CONSOLE_CHUNK_SIZE = 256 * 1024  # 控制台输出分块大小（压缩前字节数）
+
     id = db.Column(db.Integer, primary_key=True)
     record_id = db.Column(db.Integer, db.ForeignKey('records.id'))
-    cmd_line = db.Column(db.Text)  # 命令行输出
+    console_chunks = db.relationship('ConsoleChunk', backref='result', lazy='dynamic', cascade='all, delete-orphan',
+                                     order_by='ConsoleChunk.seq')
+    cmd_line = db.deferred(db.Column(db.Text))  # 命令行输出，仅旧数据使用，新数据压缩分块存放在console_chunks中
+    console_size = db.Column(db.Integer, default=0)  # 命令行输出的字节数
     status = db.Column(db.Integer)  # 任务退出码，0：成功，-1：失败
     tests = db.Column(db.Integer, default=0)
     errors = db.Column(db.Integer, default=0)
     failures = db.Column(db.Integer, default=0)
     skip = db.Column(db.Integer, default=0)
 
+    def set_console(self, console_output):
+        """保存命令行输出，按固定大小分块并压缩。
+
+        :param console_output: 命令行输出
+        :type console_output: str
+        """
+        data = console_output.encode('utf-8')
+
+        self.cmd_line = None
+        self.console_size = len(data)
+        for seq, offset in enumerate(range(0, len(data), self.CONSOLE_CHUNK_SIZE)):
+            self.console_chunks.append(
+                ConsoleChunk(seq=seq, data=zlib.compress(data[offset:offset + self.CONSOLE_CHUNK_SIZE])))
+
+    def iter_console(self):
+        """逐块读取命令行输出，每次只解压一个分块。
+
+        :return: 生成器，依次产生各分块解压后的文本
+        """
+        if self.cmd_line is not None:
+            yield self.cmd_line
+            return
+
+        # 多字节字符可能被分块截断，使用增量解码
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        for chunk in self.console_chunks:
+            yield decoder.decode(zlib.decompress(chunk.data))
+        yield decoder.decode(b'', final=True)
+
     def __repr__(self):
         return (f'<Result {self.id}, status {self.status}, tests {self.tests}, errors {self.errors}, '
                 f'failures {self.failures}, skip {self.skip}, record {self.record_id}>')
 
 
+class ConsoleChunk(db.Model):
+    """测试任务执行结果的命令行输出分块，zlib压缩存储。"""
+    __tablename__ = 'console_chunks'
+
+    id = db.Column(db.Integer, primary_key=True)
+    result_id = db.Column(db.Integer, db.ForeignKey('results.id'), index=True)
+    seq = db.Column(db.Integer)  # 分块序号
+    data = db.Column(db.LargeBinary)
+
+    def __repr__(self):
+        return f'<ConsoleChunk {self.id}, seq {self.seq}, result {self.result_id}>'
+
+
+class TestCase(db.Model):
+    """测试用例执行结果，由构建生成的JUnit XML测试报告解析得到。"""
+    __tablename__ = 'test_cases'
+
+    id = db.Column(db.Integer, primary_key=True)
+    record_id = db.Column(db.Integer, db.ForeignKey('records.id'), index=True)
+    suite = db.Column(db.String(256))
+    classname = db.Column(db.String(256))
+    name = db.Column(db.String(256))
+    status = db.Column(db.Integer)  # 0：通过，1：失败，2：出错，3：跳过
+    time = db.Column(db.Float)  # 耗时（秒）
+    message = db.Column(db.Text)
+
+    def __repr__(self):
+        return f'<TestCase {self.id}, {self.classname}.{self.name}, status {self.status}, record {self.record_id}>'
+
+
+class TestCaseHistory(db.Model):
+    """任务中各测试用例最近若干次执行结果的历史，用于发现结果在通过和失败之间反复变化的不稳定用例。
+
+    最近HISTORY_SIZE次执行的结果压缩为位图存放在outcomes中，最低位为最近一次，1为失败（含出错），跳过的执行不计入；
+    不稳定分数为位图中相邻两次结果不同的次数占比，在写入用例结果时增量更新。
+    """
+    __tablename__ = 'test_case_histories'
+    __table_args__ = (db.UniqueConstraint('task_id', 'identity'),
+                      db.Index('ix_test_case_histories_project_flaky_score', 'project_id', 'flaky_score'))
+
+    HISTORY_SIZE = 32
+
+    id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.Integer, db.ForeignKey('tasks.id'), index=True)
+    task = db.relationship('Task')
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id'))
+    identity = db.Column(db.String(40))  # classname和name的sha1
+    classname = db.Column(db.String(256))
+    name = db.Column(db.String(256))
+    outcomes = db.Column(db.BigInteger, default=0)
+    runs = db.Column(db.Integer, default=0)  # 位图中的执行次数，不超过HISTORY_SIZE
+    flips = db.Column(db.Integer, default=0)  # 位图中相邻两次结果不同的次数
+    flaky_score = db.Column(db.Float, default=0)
+    last_build_number = db.Column(db.Integer)
+    last_status = db.Column(db.Integer)  # 同TestCase.status
+
+    @staticmethod
+    def identity_of(classname, name):
+        return hashlib.sha1(f'{classname}.{name}'.encode('utf-8')).hexdigest()
+
+    def add_outcome(self, build_number, status):
+        """记录一次执行结果并更新不稳定分数。
+
+        :param build_number: 构建号，不大于已记录的构建号时忽略
+        :type build_number: int
+        :param status: 用例状态，同TestCase.status
+        :type status: int
+        """
+        if self.last_build_number is not None and build_number <= self.last_build_number:
+            return
+        self.last_build_number = build_number
+        self.last_status = status
+
+        if status == 3:
+            return
+
+        mask = (1 << self.HISTORY_SIZE) - 1
+        self.outcomes = ((self.outcomes or 0) << 1 | (1 if status in (1, 2) else 0)) & mask
+        self.runs = min((self.runs or 0) + 1, self.HISTORY_SIZE)
+
+        # 只统计有效执行次数内的相邻结果变化
+        compared = (1 << (self.runs - 1)) - 1
+        self.flips = bin((self.outcomes ^ (self.outcomes >> 1)) & compared).count('1')
+        self.flaky_score = self.flips / (self.runs - 1) if self.runs > 1 else 0
+
+    @classmethod
+    def update(cls, record, cases):
+        """将一次构建中的一批用例结果计入历史，一次查询读出已有历史，调用方负责提交会话。
+
+        新用例的历史在保存点中插入，同一任务并发导入时另一方可能已先插入，此时只回滚保存点，逐条插入并跳过已存在的用例，
+        不影响调用方事务中已写入的用例结果。
+
+        :param record: 执行记录
+        :type record: Record
+        :param cases: 由classname、name、status等组成的用例结果字典列表
+        :type cases: list
+        """
+        cases = {cls.identity_of(case['classname'], case['name']): case for case in cases}
+        histories = {history.identity: history for history in cls.query.filter(
+            cls.task_id == record.task_id, cls.identity.in_(list(cases)))}
+
+        def new_history(identity):
+            return cls(task_id=record.task_id, project_id=record.project_id, identity=identity,
+                       classname=cases[identity]['classname'], name=cases[identity]['name'], outcomes=0, runs=0,
+                       flips=0, flaky_score=0)
+
+        new = [identity for identity in cases if identity not in histories]
+        if new:
+            try:
+                with db.session.begin_nested():
+                    added = [new_history(identity) for identity in new]
+                    db.session.add_all(added)
+                histories.update((history.identity, history) for history in added)
+            except IntegrityError:
+                for identity in new:
+                    try:
+                        with db.session.begin_nested():
+                            db.session.add(new_history(identity))
+                    except IntegrityError:
+                        pass
+                histories.update((history.identity, history) for history in cls.query.filter(
+                    cls.task_id == record.task_id, cls.identity.in_(new)))
+
+        for identity, case in cases.items():
+            histories[identity].add_outcome(record.build_number, case['status'])
+
+    def to_json(self):
+        return {
+            'task_id': self.task_id,
+            'classname': self.classname,
+            'name': self.name,
+            'flaky_score': round(self.flaky_score, 4),
+            'flips': self.flips,
+            'runs': self.runs,
+            'outcomes': format(self.outcomes, f'0{self.runs}b') if self.runs else '',
+            'last_build_number': self.last_build_number,
+            'last_status': self.last_status
+        }
+
+    def __repr__(self):
+        return f'<TestCaseHistory {self.id}, {self.classname}.{self.name}, flaky {self.flaky_score}>'
+
+
+class DailyStatMixin:
+    """按天汇总的执行统计，在生成测试结果的同一事务中增量更新。子类通过KEY指定汇总维度（records表中的外键列名）。"""
+    KEY = None
+
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, index=True)
+    runs = db.Column(db.Integer, default=0)  # 执行次数
+    passed = db.Column(db.Integer, default=0)  # 执行成功次数
+    failed = db.Column(db.Integer, default=0)  # 执行失败次数
+    tests = db.Column(db.Integer, default=0)
+    errors = db.Column(db.Integer, default=0)
+    failures = db.Column(db.Integer, default=0)
+    skip = db.Column(db.Integer, default=0)
+    duration = db.Column(db.BigInteger, default=0)  # 执行总耗时（毫秒）
+
+    @classmethod
+    def increase(cls, record, result, duration):
+        """将一次执行结果累加到记录所在日期的统计中，调用方负责提交会话。
+
+        :param record: 执行记录
+        :type record: Record
+        :param result: 执行结果
+        :type result: Result
+        :param duration: 执行耗时（毫秒）
+        :type duration: int
+        """
+        key = getattr(record, cls.KEY)
+        day = record.timestamp.date()
+        passed = 1 if result.status == 0 else 0
+
+        def update():
+            # 在数据库中累加，并发结束的执行不会互相覆盖
+            return cls.query.filter(getattr(cls, cls.KEY) == key, cls.day == day).update({
+                cls.runs: cls.runs + 1, cls.passed: cls.passed + passed, cls.failed: cls.failed + 1 - passed,
+                cls.tests: cls.tests + result.tests, cls.errors: cls.errors + result.errors,
+                cls.failures: cls.failures + result.failures, cls.skip: cls.skip + result.skip,
+                cls.duration: cls.duration + duration
+            }, synchronize_session=False)
+
+        if update():
+            return
+
+        # 当天的第一次执行，插入在保存点中进行，并发的执行已先插入时只回滚保存点，改为累加，不影响调用方的事务
+        try:
+            with db.session.begin_nested():
+                db.session.add(cls(day=day, runs=1, passed=passed, failed=1 - passed, tests=result.tests,
+                                   errors=result.errors, failures=result.failures, skip=result.skip,
+                                   duration=duration, **{cls.KEY: key}))
+        except IntegrityError:
+            update()
+
+    @staticmethod
+    def series(stats):
+        """将按日期排列的统计转为按字段组织的数组，供图表使用。"""
+        return {
+            'day': [stat.day.strftime('%Y-%m-%d') for stat in stats],
+            'runs': [stat.runs for stat in stats],
+            'passed': [stat.passed for stat in stats],
+            'failed': [stat.failed for stat in stats],
+            'tests': [stat.tests for stat in stats],
+            'errors': [stat.errors for stat in stats],
+            'failures': [stat.failures for stat in stats],
+            'skip': [stat.skip for stat in stats],
+            'duration': [stat.duration for stat in stats]
+        }
+
+    @classmethod
+    def rebuild(cls):
+        """根据全部执行记录重新生成统计，历史记录没有耗时数据，按0计算。"""
+        key = getattr(Record, cls.KEY)
+        day = db.func.date(Record.timestamp)
+
+        cls.query.delete()
+        rows = db.session.query(
+            key, day, db.func.count(Record.id), db.func.sum(db.case([(Result.status == 0, 1)], else_=0)),
+            db.func.sum(Result.tests), db.func.sum(Result.errors), db.func.sum(Result.failures),
+            db.func.sum(Result.skip)).join(Result, Result.record_id == Record.id).group_by(key, day)
+
+        for key_value, day_value, runs, passed, tests, errors, failures, skip in rows:
+            if isinstance(day_value, str):
+                day_value = datetime.strptime(day_value, '%Y-%m-%d').date()
+            db.session.add(cls(day=day_value, runs=runs, passed=passed, failed=runs - passed, tests=tests or 0,
+                               errors=errors or 0, failures=failures or 0, skip=skip or 0, duration=0,
+                               **{cls.KEY: key_value}))
+        db.session.commit()
+
+
+class TaskDailyStat(DailyStatMixin, db.Model):
+    """任务每日执行统计。"""
+    __tablename__ = 'task_daily_stats'
+    __table_args__ = (db.UniqueConstraint('task_id', 'day'),)
+    KEY = 'task_id'
+
+    task_id = db.Column(db.Integer, db.ForeignKey('tasks.id'), index=True)
+
+    def __repr__(self):
+        return f'<TaskDailyStat {self.id}, task {self.task_id}, day {self.day}, runs {self.runs}>'
+
+
+class ProjectDailyStat(DailyStatMixin, db.Model):
+    """项目每日执行统计。"""
+    __tablename__ = 'project_daily_stats'
+    __table_args__ = (db.UniqueConstraint('project_id', 'day'),)
+    KEY = 'project_id'
+
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), index=True)
+
+    def __repr__(self):
+        return f'<ProjectDailyStat {self.id}, project {self.project_id}, day {self.day}, runs {self.runs}>'
+
+
 class Manual(db.Model):
     """使用说明。"""
     __tablename__ = 'manuals'
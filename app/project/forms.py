@@ -1,8 +1,8 @@
 # coding=utf-8
 
 from flask_wtf import FlaskForm
-from wtforms import StringField, TextAreaField, SubmitField, SelectField
-from wtforms.validators import InputRequired
+from wtforms import StringField, TextAreaField, SubmitField, SelectField, IntegerField
+from wtforms.validators import InputRequired, NumberRange
 from wtforms import ValidationError
 
 from ..models import Project, Server
@@ -26,6 +26,8 @@ class ProjectApplyForm(FlaskForm):
 
 class ProjectEditForm(ProjectApplyForm):
     name = StringField('名称', validators=[InputRequired()], render_kw={'readonly': 'readonly'})
+    digest_window = IntegerField('汇总邮件窗口（分钟）', default=0, validators=[NumberRange(min=0)],
+                                 description='窗口内结束的任务合并为一封通知邮件，0为每个任务单独发送')
     submit = SubmitField('提交更改')
 
     def validate_name(self, field):
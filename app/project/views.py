@@ -1,13 +1,16 @@
 # coding=utf-8
 
-from flask import render_template, url_for, redirect, flash, request, current_app, abort
+from datetime import datetime, timedelta
+
+from flask import render_template, url_for, redirect, flash, request, current_app, abort, jsonify
 from flask_login import current_user, login_required
-from jenkins import JenkinsException
 
 from . import project
 from .forms import ProjectApplyForm, ProjectEditForm
 from .. import db, jenkins
-from ..models import Project, RegistrationApplication, ProjectApplication, Server, OperatingRecord
+from ..celery_tasks import start_migration, continue_migration, start_rollback, migration_state
+from ..models import (Project, RegistrationApplication, ProjectApplication, Server, OperatingRecord, TaskDailyStat,
+                      ProjectDailyStat, TestCaseHistory)
 
 
 @project.route('/')
@@ -45,32 +48,23 @@ def project_info(project_id):
 
         # 校验当前用户是否有修改项目权限
         if current_user in p.editors:
-            try:
-                server = Server.query.get(form.server_id.data)
-                if p.server != server:
-                    # 修改jenkins上任务的测试服务器
-                    import xml.etree.ElementTree as ET
-
-                    for task in p.tasks:
-                        config = jenkins.get_job_config(task.name)
-                        root = ET.fromstring(config)
-
-                        root.find('assignedNode').text = server.host
-                        jenkins.reconfig_job(task.name, ET.tostring(root).decode('utf-8'))
-
-                p.name = form.name.data
-                p.info = form.info.data
-                p.server = server
-                db.session.add(p)
-                operating_record = OperatingRecord(user=current_user, operation='修改', project=p)
-                db.session.add(operating_record)
-                db.session.commit()
-
-                current_app.logger.info(f'user {current_user} edited the project {p}')
-            except JenkinsException as e:
-                current_app.logger.error('jenkins edit job error')
-                current_app.logger.exception(e)
-                flash('内部错误', 'danger')
+            server = Server.query.get(form.server_id.data)
+            if p.server != server:
+                # 修改jenkins上任务的测试服务器在后台进行，全部任务修改成功后才修改项目的测试服务器
+                if start_migration(p, server):
+                    flash('测试服务器修改已在后台进行', 'info')
+                else:
+                    flash('测试服务器正在修改中，请稍后再试', 'warning')
+
+            p.name = form.name.data
+            p.info = form.info.data
+            p.digest_window = form.digest_window.data
+            db.session.add(p)
+            operating_record = OperatingRecord(user=current_user, operation='修改', project=p)
+            db.session.add(operating_record)
+            db.session.commit()
+
+            current_app.logger.info(f'user {current_user} edited the project {p}')
 
             return redirect(url_for('.project_list'))
         else:
@@ -82,16 +76,104 @@ def project_info(project_id):
     form.name.data = p.name
     form.info.data = p.info
     form.server_id.data = p.server_id
+    form.digest_window.data = p.digest_window or 0
 
     # 获取项目信息，若用户有修改权限，则会显示该项目的服务器信息和修改提交按钮
     if current_user in p.editors:
         current_app.logger.debug(f'user {current_user}, can edit the project {p}')
-        return render_template('project/project.html', form=form, project=p, can_edit=True)
+        return render_template('project/project.html', form=form, project=p, can_edit=True,
+                               migration=migration_state(p.id))
     else:
         current_app.logger.debug(f'user {current_user}, can\'t edit the project {p}')
         return render_template('project/project.html', form=form, project=p, can_edit=False)
 
 
+@project.route('/<project_id>/migration')
+@login_required
+def migration(project_id):
+    """项目修改测试服务器的进度及各任务的状态。"""
+    current_app.logger.debug('get {}'.format(url_for('.migration', project_id=project_id)))
+
+    p = _editable_project(project_id)
+    return jsonify(migration=migration_state(p.id))
+
+
+def _editable_project(project_id):
+    p = Project.query.get(project_id)
+    if current_user not in p.editors:
+        current_app.logger.warning(f'user {current_user} is forbade to edit the project {p}')
+        abort(403)
+    return p
+
+
+@project.route('/<project_id>/migration/resume')
+@login_required
+def resume_migration(project_id):
+    """继续未完成的测试服务器修改，已修改成功的任务不再重复修改。"""
+    current_app.logger.debug('get {}'.format(url_for('.resume_migration', project_id=project_id)))
+
+    p = _editable_project(project_id)
+    if continue_migration(p.id):
+        current_app.logger.info(f'user {current_user} resumed the migration of {p}')
+    return redirect(url_for('.project_info', project_id=project_id))
+
+
+@project.route('/<project_id>/migration/rollback')
+@login_required
+def rollback_migration(project_id):
+    """将未完成的测试服务器修改中已修改的任务改回原测试服务器。"""
+    current_app.logger.debug('get {}'.format(url_for('.rollback_migration', project_id=project_id)))
+
+    p = _editable_project(project_id)
+    if start_rollback(p.id):
+        current_app.logger.info(f'user {current_user} rolled back the migration of {p}')
+    return redirect(url_for('.project_info', project_id=project_id))
+
+
+@project.route('/<project_id>/daily')
+@login_required
+def daily(project_id):
+    """项目最近days天（默认30天）的每日执行统计，读取预先汇总的数据。"""
+    days = request.args.get('days', 30, type=int)
+    current_app.logger.debug('get {}'.format(url_for('.daily', project_id=project_id, days=days)))
+
+    stats = ProjectDailyStat.query.filter(ProjectDailyStat.project_id == project_id,
+                                          ProjectDailyStat.day > datetime.utcnow().date() - timedelta(days=days)
+                                          ).order_by(ProjectDailyStat.day).all()
+
+    return jsonify(**ProjectDailyStat.series(stats))
+
+
+@project.route('/<project_id>/flaky/')
+@login_required
+def flaky(project_id):
+    """项目中最不稳定的测试用例。"""
+    limit = request.args.get('limit', 20, type=int)
+    current_app.logger.debug('get {}'.format(url_for('.flaky', project_id=project_id, limit=limit)))
+
+    p = Project.query.get(project_id)
+    histories = TestCaseHistory.query.options(db.joinedload('task')).filter(
+        TestCaseHistory.project_id == project_id, TestCaseHistory.flaky_score > 0).order_by(
+        TestCaseHistory.flaky_score.desc()).limit(limit).all()
+
+    return render_template('project/flaky.html', project=p, histories=histories,
+                           history_size=TestCaseHistory.HISTORY_SIZE)
+
+
+@project.route('/<project_id>/flaky.json')
+@login_required
+def flaky_json(project_id):
+    """项目中最不稳定的limit个（默认20）测试用例，按不稳定分数降序排列。"""
+    limit = request.args.get('limit', 20, type=int)
+    current_app.logger.debug('get {}'.format(url_for('.flaky_json', project_id=project_id, limit=limit)))
+
+    histories = TestCaseHistory.query.filter(TestCaseHistory.project_id == project_id,
+                                             TestCaseHistory.flaky_score > 0).order_by(
+        TestCaseHistory.flaky_score.desc()).limit(limit).all()
+
+    return jsonify(test_cases=[history.to_json() for history in histories])
+
+
 @project.route('/delete/')
 @login_required
 def delete():
@@ -104,8 +186,11 @@ def delete():
     if current_user and current_user in p.editors:
         for task in p.tasks:
             jenkins.delete_job(task.name)
+            TaskDailyStat.query.filter_by(task_id=task.id).delete()
+            TestCaseHistory.query.filter_by(task_id=task.id).delete()
             db.session.delete(task)
             current_app.logger.debug(f'deleted task {task}')
+        ProjectDailyStat.query.filter_by(project_id=p.id).delete()
 
         for user in p.active_users:
             from itertools import chain
@@ -128,6 +213,7 @@ def delete():
             current_app.logger.debug(f'deleted project application {application}')
 
         for record in p.records:
+            record.test_cases.delete()
             db.session.delete(record.result)
             db.session.delete(record)
             current_app.logger.debug(f'deleted record {record}')
@@ -1,20 +1,27 @@
 # coding=utf-8
 
+import hmac
 import json
 
 import redis
 from jenkins import JenkinsException
-from flask import render_template, url_for, request, jsonify, current_app, abort
+from flask import render_template, url_for, request, jsonify, current_app, abort, Response, stream_with_context
 from flask_login import current_user, login_required
 
 from . import record
 from .. import db, jenkins
-from ..celery_tasks import send_email
-from ..models import Record, Project, Task, Result, EmailTemplate, OperatingRecord
-from ..tools import get_sftp_file
+from ..celery_tasks import (finalize_record, post_finalize, result_key, RESULT_FIELDS, RESULT_EXPIRE, dispatch_server,
+                            server_online, dispatched_records)
+from ..console_stream import subscribe
+from ..dispatch import positions, PRIORITIES
+from ..jenkins_api import get_progressive_text, get_build_info, invalidate_build
+from ..record_state import get_states, wait_for_states, waiter_slot
+from ..models import Record, Project, Task, OperatingRecord
 
 r = redis.Redis('localhost')
 
+STATES_RETRY_AFTER = 5  # 长轮询名额已满时建议页面再次查询的间隔（秒）
+
 
 @record.route('/')
 @login_required
@@ -32,12 +39,15 @@ def record_list():
     current_app.logger.debug('get {}'.format(url_for('.record_list', project_id=project_id, task_id=task_id,
                                                      page=page)))
 
+    # 页面用到的关联对象一次查出，避免逐行懒加载
+    query = Record.query.options(db.joinedload('result'), db.joinedload('user'), db.joinedload('task'),
+                                 db.joinedload('project'))
     if task_id != -1:
-        pagination = Record.query.filter_by(project_id=project_id, task_id=task_id).order_by(
+        pagination = query.filter_by(project_id=project_id, task_id=task_id).order_by(
             Record.timestamp.desc()).paginate(page, per_page=current_app.config['POLARIS_RECORDS_PER_PAGE'],
                                               error_out=False)
     else:
-        pagination = Record.query.filter_by(project_id=project_id).order_by(
+        pagination = query.filter_by(project_id=project_id).order_by(
             Record.timestamp.desc()).paginate(page, per_page=current_app.config['POLARIS_RECORDS_PER_PAGE'],
                                               error_out=False)
 
@@ -50,7 +60,8 @@ def record_list():
 @record.route('/<record_id>/console/')
 @login_required
 def console(record_id):
-    test_record = Record.query.get(record_id)
+    # 只有控制台页面需要读取旧数据的命令行输出
+    test_record = Record.query.options(db.joinedload('result').undefer('cmd_line')).get(record_id)
     p = test_record.project
 
     if current_user not in p.testers and current_user not in p.editors:
@@ -59,44 +70,73 @@ def console(record_id):
 
     current_app.logger.debug('get {}'.format(url_for('.console', record_id=record_id)))
 
-    try:
-        console_output = jenkins.get_build_console_output(test_record.task.name, test_record.build_number).replace(
-            '\r', '').replace('\n', '<br>')
-        r.set(f'console_output:{test_record.task.name}:{test_record.build_number}', console_output)
-    except JenkinsException as e:
-        current_app.logger.error('connect Jenkins error')
-        current_app.logger.exception(e)
-        abort(500)
+    if test_record.result:
+        # 已结束的记录从数据库中逐块解压输出，边解压边返回页面
+        context = dict(record_id=test_record.id, task_name=test_record.task.name,
+                       build_number=test_record.build_number, finished=True,
+                       console_output=(text.replace('\r', '').replace('\n', '<br>')
+                                       for text in test_record.result.iter_console()))
+        current_app.update_template_context(context)
+        template = current_app.jinja_env.get_template('record/console.html')
+        return Response(stream_with_context(template.generate(context)))
 
-    return render_template('record/console.html', ret=console_output, task_name=test_record.task.name,
-                           build_number=test_record.build_number)
+    # 控制台输出由页面通过console_stream订阅，不支持Server-Sent Events的浏览器通过console_check按偏移增量获取
+    return render_template('record/console.html', record_id=test_record.id, task_name=test_record.task.name,
+                           build_number=test_record.build_number, finished=False)
 
 
 @record.route('/console_check/')
 def console_check():
+    """按字节偏移增量获取控制台输出，只返回start之后的新内容及下次读取的偏移。"""
     task_name = request.args.get('task_name')
     build_number = request.args.get('build_number', type=int)
-    current_app.logger.debug('get {}'.format(url_for('.console_check', task_name=task_name, build_number=build_number)))
-
-    end = False
-    console_output = r.get(f'console_output:{task_name}:{build_number}').decode('utf-8')
-    console_output_new = console_output
+    start = request.args.get('start', 0, type=int)
+    current_app.logger.debug('get {}'.format(url_for('.console_check', task_name=task_name, build_number=build_number,
+                                                     start=start)))
 
     try:
-        console_output_new = (
-            jenkins.get_build_console_output(task_name, build_number).replace('\r', '').replace('\n', '<br>'))
-        r.set(f'console_output:{task_name}:{build_number}', console_output_new)
-
-        build_info = jenkins.get_build_info(task_name, build_number)
-        if build_info['result']:
-            end = True
-            current_app.logger.info('build end')
+        console_output, start, more_data = get_progressive_text(task_name, build_number, start)
     except JenkinsException as e:
         current_app.logger.error('connect Jenkins error')
         current_app.logger.exception(e)
+        return jsonify(ret='', start=start, end=False)
+
+    if not more_data:
+        current_app.logger.info('build end')
 
-    console_output = console_output_new.lstrip(console_output)
-    return jsonify(ret=console_output, end=end)
+    return jsonify(ret=console_output.replace('\r', '').replace('\n', '<br>'), start=start, end=not more_data)
+
+
+@record.route('/<record_id>/console/stream')
+@login_required
+def console_stream(record_id):
+    """以Server-Sent Events推送控制台输出，同一构建的所有查看者共享一个jenkins读取线程。"""
+    test_record = Record.query.get(record_id)
+    p = test_record.project
+
+    if current_user not in p.testers and current_user not in p.editors:
+        current_app.logger.warning(f'user {current_user} is disallowed to get console output of record {test_record}')
+        abort(403)
+
+    # 浏览器断线重连时通过Last-Event-ID带回已读取的偏移
+    start = int(request.headers.get('Last-Event-ID') or request.args.get('start', 0, type=int))
+    current_app.logger.debug('get {}'.format(url_for('.console_stream', record_id=record_id, start=start)))
+
+    def generate():
+        try:
+            for console_output, offset, end in subscribe(test_record.task.name, test_record.build_number, start):
+                if console_output or end:
+                    data = json.dumps({'ret': console_output.replace('\r', '').replace('\n', '<br>'), 'end': end})
+                    yield f'id: {offset}\ndata: {data}\n\n'
+                else:
+                    # 保持连接，同时及时发现查看者离开
+                    yield ': keepalive\n\n'
+        except JenkinsException as e:
+            current_app.logger.error('connect Jenkins error')
+            current_app.logger.exception(e)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @record.route('/<record_id>/analysis/')
@@ -130,121 +170,201 @@ def analysis(record_id):
     return render_template('record/analysis.html', ret=ret)
 
 
+def _parse_report(data):
+    """解析并校验一条测试结果上报，各结果字段转为整数。
+
+    :param data: json格式的上报
+    :type data: str
+    :return: 上报字典，格式错误时抛出ValueError、TypeError或KeyError
+    """
+    result = json.loads(data)
+    if not isinstance(result, dict) or not isinstance(result['project_name'], str) or \
+            not isinstance(result['task_name'], str):
+        raise ValueError('invalid field type')
+    for field in RESULT_FIELDS:
+        result[field] = int(result[field])
+    return result
+
+
+def _store_report(pipe, result):
+    """将一条测试结果上报加入redis管道，同一构建的多次上报累加。"""
+    if result.get('build_number'):
+        key = result_key(result['project_name'], result['task_name'], result['build_number'])
+        for field in RESULT_FIELDS:
+            pipe.hincrby(key, field, result[field])
+        pipe.expire(key, RESULT_EXPIRE)
+    else:
+        for field in RESULT_FIELDS:
+            pipe.rpush(f'result:{field}:{result["project_name"]}:{result["task_name"]}', result[field])
+
+
 @record.route('/report_result', methods=['POST'])
 def report_result():
-    """接收测试结果数据上报。"""
-    result = json.loads(request.get_data().decode('utf-8'))
+    """接收测试结果数据上报，格式错误时返回400。"""
+    try:
+        result = _parse_report(request.get_data().decode('utf-8'))
+    except (ValueError, TypeError, KeyError) as e:
+        current_app.logger.warning(f'invalid result report: {e!r}')
+        return jsonify(status=-1, msg='invalid result report'), 400
     current_app.logger.info(f'get result report: {result}')
 
-    r.rpush(f'result:tests:{result["project_name"]}:{result["task_name"]}', result['tests'])
-    r.rpush(f'result:errors:{result["project_name"]}:{result["task_name"]}', result['errors'])
-    r.rpush(f'result:failures:{result["project_name"]}:{result["task_name"]}', result['failures'])
-    r.rpush(f'result:skip:{result["project_name"]}:{result["task_name"]}', result['skip'])
+    # 所有字段在一个事务中写入
+    with r.pipeline() as pipe:
+        _store_report(pipe, result)
+        pipe.execute()
 
     return jsonify(status=0, msg='ok')
 
 
-@record.route('/check_state/')
-def check_state():
-    """检查某个任务执行状态，通过ajax调用。"""
-    task_id = request.args.get('task_id', type=int)
-    task = Task.query.get(task_id)
-    current_app.logger.debug('get {}'.format(url_for('.check_state', task_id=task_id)))
+@record.route('/report_results', methods=['POST'])
+def report_results():
+    """批量接收测试结果数据上报，请求体每行一条json格式的上报（NDJSON）。
 
-    # 查询任务的状态
-    # 0：任务在执行中
-    # 1：任务从执行中切换到了执行结束状态，前端刷新页面
-    # -1：任务处于结束状态，前端停止状态检查
-    state = 0
+    格式错误的上报不影响其他上报的写入，此时返回400，rejected为被拒绝的上报在批次中的序号（从0开始，不计空行）。
+    """
+    try:
+        lines = [line for line in request.get_data().decode('utf-8').splitlines() if line.strip()]
+    except UnicodeDecodeError as e:
+        current_app.logger.warning(f'invalid result reports: {e!r}')
+        return jsonify(status=-1, msg='invalid result reports', count=0, rejected=[]), 400
+
+    results, rejected = [], []
+    for i, line in enumerate(lines):
+        try:
+            results.append(_parse_report(line))
+        except (ValueError, TypeError, KeyError) as e:
+            current_app.logger.warning(f'invalid result report #{i}: {e!r}')
+            rejected.append(i)
+    current_app.logger.info(f'get {len(lines)} result reports, rejected {len(rejected)}')
+
+    # 整批有效的上报在一个事务中写入
+    with r.pipeline() as pipe:
+        for result in results:
+            _store_report(pipe, result)
+        pipe.execute()
+
+    if rejected:
+        return jsonify(status=-1, msg='invalid result reports', count=len(results), rejected=rejected), 400
+    return jsonify(status=0, msg='ok', count=len(results))
+
+
+@record.route('/build_event', methods=['POST'])
+def build_event():
+    """接收jenkins Notification插件推送的构建事件，构建结束后立即生成测试结果。
+
+    请求需携带与POLARIS_BUILD_EVENT_TOKEN一致的token参数，任务创建时会自动在jenkins任务中配置该地址。
+    """
+    token = current_app.config['POLARIS_BUILD_EVENT_TOKEN']
+    if not token or not hmac.compare_digest(request.args.get('token', ''), token):
+        current_app.logger.warning('build event with invalid token')
+        abort(403)
 
-    if task:
+    try:
+        event = json.loads(request.get_data().decode('utf-8'))
+        build = event['build']
+        if not isinstance(event['name'], str) or not isinstance(build['number'], int) or \
+                not isinstance(build['phase'], str):
+            raise ValueError('invalid field type')
+    except (ValueError, TypeError, KeyError) as e:
+        # json解析错误（JSONDecodeError、UnicodeDecodeError）均为ValueError的子类
+        current_app.logger.warning(f'invalid build event: {e!r}')
+        return jsonify(status=-1, msg='invalid build event'), 400
+
+    current_app.logger.info(f'get build event: {event["name"]} #{build["number"]} {build["phase"]}')
+
+    task = Task.query.filter_by(name=event['name']).first()
+    if task is None:
+        current_app.logger.warning(f'task {event["name"]} not found')
+        return jsonify(status=-1, msg='task not found')
+
+    # 构建状态已变化（包括定时触发的构建），缓存的构建信息失效
+    invalidate_build(task.name, build['number'])
+
+    # 根据jenkins的构建记录查询数据库中的记录，数据库中没有该记录（如定时执行）则添加进去
+    # 等待执行的记录尚未派发，其构建号是旧版本猜测的，不据此对应构建
+    rcd = Record.query.filter_by(task=task).filter_by(build_number=build['number']).filter(Record.state != -2).first()
+    if rcd is None:
+        # 平台派发的构建根据队列项id确定对应的记录
+        rcd = dispatched_records(task).get(build.get('queue_id'))
+    if rcd is None:
+        rcd = Record(user=None, project=task.project, task=task, state=0, version='9999')
+        db.session.add(rcd)
+    rcd.build_number = build['number']
+    db.session.commit()
+
+    # FINALIZED在构建后脚本（结果统计）执行完毕后推送
+    if build['phase'] == 'FINALIZED' and rcd.state == 0:
         try:
-            job_info = jenkins.get_job_info(task.name)
-            build = job_info['builds'][0]
-            build_number = build['number']
-
-            # 根据jenkins的构建记录查询数据库中的记录
-            rcd = Record.query.filter_by(task=task).filter_by(build_number=build_number).first()
-            current_app.logger.debug(f'record of the build {build}: {rcd}')
-
-            if rcd.state == -2:
-                rcd.state = 0
-                db.session.commit()
-
-            # 查询记录是否已经执行完毕
-            if rcd.state == 0:
-                build_info = jenkins.get_build_info(rcd.task.name, rcd.build_number)
-                if build_info['result']:
-                    console_output = jenkins.get_build_console_output(rcd.task.name, rcd.build_number)
-
-                    test_result = Result(record=rcd, status=0 if build_info['result'] == 'SUCCESS' else -1,
-                                         cmd_line=console_output, tests=0, errors=0, failures=0, skip=0)
-
-                    tests = r.lpop(f'result:tests:{rcd.project.name}:{rcd.task.nickname}')
-                    errors = r.lpop(f'result:errors:{rcd.project.name}:{rcd.task.nickname}')
-                    failures = r.lpop(f'result:failures:{rcd.project.name}:{rcd.task.nickname}')
-                    skip = r.lpop(f'result:skip:{rcd.project.name}:{rcd.task.nickname}')
-
-                    if tests:
-                        test_result.tests += int(tests)
-                        test_result.errors += int(errors)
-                        test_result.failures += int(failures)
-                        test_result.skip += int(skip)
-
-                    db.session.add(test_result)
-
-                    if build_info['result'] == 'SUCCESS':
-                        current_app.logger.debug('{} success'.format(rcd))
-                        rcd.state = 1
-                    else:
-                        current_app.logger.debug('{} fail'.format(rcd))
-                        rcd.state = -1
-                    rcd.result = test_result
-                    db.session.commit()
-
-                    state = 1
-
-                    if rcd.task.email_notification_enable and rcd.task.email_receivers:
-                        receivers = rcd.task.email_receivers.replace('， ', ',').replace(', ', ',').replace('，', ',')
-                        receivers = receivers.split(',')
-
-                        attachments = []
-                        for att in rcd.task.email_attachments.split(';'):
-                            current_app.logger.debug(f'reading remote file: {att}')
-                            try:
-                                with get_sftp_file(rcd.project.server.host, rcd.project.server.username,
-                                                   rcd.project.server.password, att, 'rb') as fp:
-                                    data = fp.read()
-                                    attachments.append((att.replace('\\', '/').split('/')[-1], data))
-                            except FileNotFoundError:
-                                current_app.logger.error('file not found')
-
-                        attachments.append(('console.log', test_result.cmd_line.replace('\n', '\r\n').encode('utf8')))
-
-                        send_email.delay(current_app.config['EMAIL_HOST'], current_app.config['EMAIL_SENDER'],
-                                         current_app.config['EMAIL_SENDER_PASSWORD'],
-                                         receivers, f'{rcd.task.name} 测试结果：{"成功" if rcd.state == 1 else "失败"}',
-                                         rcd.task.email_body_html or
-                                         EmailTemplate.query.order_by(EmailTemplate.timestamp.desc()).first().body_html,
-                                         (test_result.tests, test_result.errors, test_result.failures, test_result.skip)
-                                         if test_result.tests != 0 else None, attachments)
-            elif rcd.state == 1 or rcd.state == -1:
-                state = -1
+            build_result, duration = build.get('status'), build.get('duration')
+            if not build_result:
+                build_info = get_build_info(task.name, rcd.build_number)
+                build_result, duration = build_info['result'], build_info['duration']
+            console_output = jenkins.get_build_console_output(task.name, rcd.build_number)
         except JenkinsException as e:
+            # 留给定时状态检查补偿
             current_app.logger.error('connect Jenkins error')
             current_app.logger.exception(e)
-            state = -1
+            return jsonify(status=-1, msg='jenkins error')
+
+        test_result = finalize_record(rcd, build_result, console_output, duration)
+        db.session.commit()
+        if test_result is None:
+            # 定时检查已先结束该记录
+            return jsonify(status=0, msg='ok')
+        current_app.logger.info(f'finalized record: {rcd}')
 
-    return jsonify(state=state)
+        post_finalize(rcd)
+
+    return jsonify(status=0, msg='ok')
+
+
+@record.route('/states')
+@login_required
+def states():
+    """批量查询执行记录的状态，参数record_id、task_id可传入多个，task_id查询任务最近一次执行记录的状态。
+
+    带上次结果的ETag（If-None-Match）请求时，状态未变化返回304；同时传入wait参数时，
+    在服务端最多等待wait秒（不超过POLARIS_STATES_MAX_WAIT），状态变化后立即返回。
+    本进程等待的请求已达POLARIS_STATES_MAX_WAITERS个时不等待，通过Retry-After响应头告知页面稍后再查询。
+    """
+    record_ids = request.args.getlist('record_id', type=int)
+    task_ids = request.args.getlist('task_id', type=int)
+    wait = min(request.args.get('wait', 0, type=float), current_app.config['POLARIS_STATES_MAX_WAIT'])
+
+    headers = {}
+    etag = next(iter(request.if_none_match), None)
+    if etag and wait > 0:
+        with waiter_slot(current_app.config['POLARIS_STATES_MAX_WAITERS']) as acquired:
+            if acquired:
+                data, current_etag = wait_for_states(record_ids, task_ids, etag, wait)
+            else:
+                current_app.logger.warning('too many waiting state requests')
+                data, current_etag = get_states(record_ids, task_ids)
+                headers['Retry-After'] = str(STATES_RETRY_AFTER)
+    else:
+        data, current_etag = get_states(record_ids, task_ids)
+
+    if current_etag in request.if_none_match:
+        headers['ETag'] = f'"{current_etag}"'
+        return Response(status=304, headers=headers)
+
+    response = jsonify(**data)
+    response.set_etag(current_etag)
+    response.headers.extend(headers)
+    return response
 
 
 @record.route('/do_test')
 @login_required
 def do_test():
-    """执行测试接口，通过ajax调用。"""
+    """执行测试接口，通过ajax调用。
+
+    执行请求加入测试服务器的派发队列，服务器有空闲执行器时立即派发，否则返回在队列中的位置。
+    """
     project_id = request.args.get('project_id', type=int)
     task_id = request.args.get('task_id', type=int)
     version = request.args.get('version')
+    priority = request.args.get('priority', 0, type=int)
     current_app.logger.debug(f'get {url_for(".do_test", project_id=project_id, task_id=task_id, version=version)}')
 
     p = Project.query.get(project_id)
@@ -254,42 +374,27 @@ def do_test():
         current_app.logger.warning(f'user {current_user} is disallowed to do test of task {t}')
         return jsonify(state='no_permission')
 
-    try:
-        build_number = jenkins.get_job_info(t.name)['nextBuildNumber']
-        current_app.logger.debug(f'build number: {build_number}')
-
-        if not jenkins.get_node_info(p.server.host)['offline']:
-            # 测试服务器在线
-            if Record.query.filter_by(task=t, state=0).first() or Record.query.filter_by(task=t, state=-2).first():
-                # 该任务正在执行中
-                current_app.logger.debug('the task is in testing')
-                return jsonify(state='busy')
-
-            jenkins.build_job(t.name)
-            test_record = Record(user=current_user, project=p, task=t, state=0, version=version,
-                                 build_number=build_number)
-            operating_record = OperatingRecord(user=current_user, operation='执行测试', task=t)
-            db.session.add(test_record)
-            db.session.add(operating_record)
-            db.session.commit()
-
-            current_app.logger.info(f'created record: {test_record}')
-            return jsonify(state='success')
-        else:
-            # 测试服务器离线
-            current_app.logger.warning(f'{p.server} offline')
-
-            if not Record.query.filter_by(task=t, state=-2).first():
-                test_record = Record(user=current_user, project=p, task=t, state=-2, version=version,
-                                     build_number=build_number)
-                db.session.add(test_record)
-                db.session.commit()
-
-                current_app.logger.info(f'created record: {test_record}')
-                return jsonify(state='timeout')
-            else:
-                return jsonify(state='wait')
-    except JenkinsException as e:
-        current_app.logger.error('connect Jenkins error')
-        current_app.logger.exception(e)
-        return jsonify(state='j_error')
+    test_record = Record.query.filter_by(task=t, state=-2).first()
+    if test_record:
+        # 该任务已在队列中
+        current_app.logger.debug('the task is waiting')
+        return jsonify(state='queued', position=positions(p.server_id).get(test_record.id, 0))
+
+    test_record = Record(user=current_user, project=p, task=t, state=-2, version=version,
+                         priority=priority if priority in PRIORITIES else 0)
+    operating_record = OperatingRecord(user=current_user, operation='执行测试', task=t)
+    db.session.add(test_record)
+    db.session.add(operating_record)
+    db.session.commit()
+    current_app.logger.info(f'queued record: {test_record}')
+
+    dispatch_server(p.server_id)
+    if test_record.state == 0:
+        return jsonify(state='success')
+
+    if not server_online(p.server):
+        # 测试服务器离线
+        current_app.logger.warning(f'{p.server} offline')
+        return jsonify(state='timeout')
+
+    return jsonify(state='queued', position=positions(p.server_id).get(test_record.id, 0))
@@ -0,0 +1,206 @@
+# coding=utf-8
+
+"""
+执行记录状态的批量查询。
+
+执行记录的状态变化提交后，递增redis中该记录、所属任务及所在服务器队列的版本号，并发布变化的版本号字段；
+查询结果按查询的id集合缓存在redis中，涉及的版本号都未变化时直接返回缓存，不访问数据库。
+页面可带上次结果的ETag长轮询，状态不变时请求在服务端等待，只有涉及的记录、任务或服务器队列变化时才重新查询。
+
+长轮询的请求在等待期间占用worker，需以多线程或协程方式部署（如gunicorn的eventlet worker），
+每个进程同时等待的请求数由POLARIS_STATES_MAX_WAITERS限制。
+"""
+
+import json
+import time
+import zlib
+import hashlib
+import threading
+from contextlib import contextmanager
+
+import redis
+from sqlalchemy.orm.attributes import NO_VALUE
+
+from . import db
+from .dispatch import positions
+from .models import Record, Project
+
+r = redis.Redis('localhost')
+
+STATES_VERSION = 'records:states:version:{}'  # 版本号的键，字段为r:记录id、t:任务id、s:服务器id
+STATES_VERSION_EXPIRE = 24 * 3600  # 版本号的保留时间（秒），远大于查询结果的缓存时间，过期后从0重新计数不会误用缓存
+STATES_CHANNEL = 'records:states:changed'  # 状态变化的通知频道，消息为变化的版本号字段列表
+STATES_CACHE_EXPIRE = 60  # 查询结果的缓存时间（秒）
+
+_waiters = 0  # 本进程中正在长轮询等待的请求数
+_waiters_lock = threading.Lock()
+
+
+def _on_changed_state(target, value, oldvalue, initiator):
+    if value != oldvalue or oldvalue is NO_VALUE:
+        db.session.info.setdefault('record_state_targets', set()).add(target)
+
+
+def _after_flush(session, flush_context):
+    # flush后新记录的id和外键才确定
+    targets = session.info.pop('record_state_targets', None)
+    if not targets:
+        return
+
+    # 等待记录的队列位置随所在服务器上任一记录的状态变化而变化
+    servers = dict(session.query(Project.id, Project.server_id).filter(
+        Project.id.in_({rcd.project_id for rcd in targets})))
+    changed = session.info.setdefault('record_state_changed', set())
+    for rcd in targets:
+        changed.update((f'r:{rcd.id}', f't:{rcd.task_id}', f's:{servers.get(rcd.project_id)}'))
+
+
+def _after_commit(session):
+    changed = session.info.pop('record_state_changed', None)
+    if changed:
+        pipe = r.pipeline()
+        for field in changed:
+            pipe.incr(STATES_VERSION.format(field))
+            pipe.expire(STATES_VERSION.format(field), STATES_VERSION_EXPIRE)
+        pipe.publish(STATES_CHANNEL, json.dumps(sorted(changed)))
+        pipe.execute()
+
+
+def _after_rollback(session):
+    session.info.pop('record_state_targets', None)
+    session.info.pop('record_state_changed', None)
+
+
+db.event.listen(Record.state, 'set', _on_changed_state)
+db.event.listen(db.session, 'after_flush', _after_flush)
+db.event.listen(db.session, 'after_commit', _after_commit)
+db.event.listen(db.session, 'after_rollback', _after_rollback)
+
+
+def _versions(fields):
+    if not fields:
+        return []
+    return [int(version or 0) for version in r.mget([STATES_VERSION.format(field) for field in fields])]
+
+
+def _query_states(record_ids, task_ids):
+    """查询执行记录及任务最近一次执行记录的状态。
+
+    :return: 状态数据，以及等待执行的记录id到所在服务器id的字典组成的元组
+    """
+    records = {}
+    waiting = {}
+    if record_ids:
+        rows = db.session.query(Record.id, Record.state, Project.server_id).join(
+            Project, Record.project_id == Project.id).filter(Record.id.in_(record_ids)).all()
+        records = {record_id: state for record_id, state, _ in rows}
+        waiting = {record_id: server_id for record_id, state, server_id in rows if state == -2}
+
+    tasks = {}
+    if task_ids:
+        latest = db.session.query(db.func.max(Record.id)).filter(Record.task_id.in_(task_ids)).group_by(
+            Record.task_id)
+        tasks = {task_id: {'record_id': record_id, 'state': state} for record_id, task_id, state in db.session.query(
+            Record.id, Record.task_id, Record.state).filter(Record.id.in_(latest.subquery()))}
+
+    return {'records': records, 'tasks': tasks}, waiting
+
+
+def _get_states(record_ids, task_ids):
+    """同get_states，另返回结果涉及的版本号字段集合。"""
+    ids = [sorted(record_ids), sorted(task_ids)]
+    key = 'records:states:{:08x}'.format(zlib.crc32(json.dumps(ids).encode()))
+
+    cached = r.get(key)
+    if cached is not None:
+        cached = json.loads(cached.decode('utf-8'))
+        if cached['ids'] == ids and cached['versions'] == _versions(cached['fields']):
+            return cached['states'], cached['etag'], set(cached['fields'])
+
+    # 先读版本号再查询，查询期间的变化会使下次读取时版本号不一致，不会缓存旧状态
+    fields = [f'r:{record_id}' for record_id in ids[0]] + [f't:{task_id}' for task_id in ids[1]]
+    versions = _versions(fields)
+    states, waiting = _query_states(record_ids, task_ids)
+
+    # 等待执行的记录的队列位置，同样先读所在服务器队列的版本号再查询
+    servers = sorted(set(waiting.values()))
+    fields += [f's:{server_id}' for server_id in servers]
+    versions += _versions([f's:{server_id}' for server_id in servers])
+    queue_positions = {}
+    for server_id in servers:
+        queue_positions.update(positions(server_id))
+    states['positions'] = {record_id: queue_positions[record_id] for record_id in waiting
+                           if record_id in queue_positions}
+
+    # 转为json中的形式（id为字符串），与缓存中读出的结果一致
+    states = json.loads(json.dumps(states))
+    etag = hashlib.sha1(json.dumps(states, sort_keys=True).encode('utf-8')).hexdigest()
+    r.set(key, json.dumps({'ids': ids, 'fields': fields, 'versions': versions, 'states': states, 'etag': etag}),
+          ex=STATES_CACHE_EXPIRE)
+    return states, etag, set(fields)
+
+
+def get_states(record_ids, task_ids):
+    """查询执行记录及任务最近一次执行记录的状态。
+
+    :param record_ids: 执行记录id列表
+    :type record_ids: list
+    :param task_ids: 任务id列表
+    :type task_ids: list
+    :return: 状态数据及其ETag组成的元组，状态数据由执行记录id到状态的字典、等待执行的记录id到其在队列中位置的字典，
+             以及任务id到最近一次执行记录id和状态组成的字典的字典组成
+    """
+    states, etag, _ = _get_states(record_ids, task_ids)
+    return states, etag
+
+
+@contextmanager
+def waiter_slot(limit):
+    """占用本进程的一个长轮询名额。
+
+    :param limit: 本进程同时等待的最大请求数
+    :type limit: int
+    :return: 是否占用成功，已有limit个请求在等待时为False，调用方应立即返回
+    """
+    global _waiters
+
+    with _waiters_lock:
+        acquired = _waiters < limit
+        if acquired:
+            _waiters += 1
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with _waiters_lock:
+                _waiters -= 1
+
+
+def wait_for_states(record_ids, task_ids, etag, timeout):
+    """等待状态与etag不同或超时，只有涉及的记录、任务或服务器队列变化时才重新查询。
+
+    :param etag: 调用方已有结果的ETag
+    :type etag: str
+    :param timeout: 最长等待时间（秒）
+    :type timeout: float
+    :return: 同get_states
+    """
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(STATES_CHANNEL)
+    try:
+        deadline = time.time() + timeout
+        while True:
+            # 先订阅再查询，查询之后的变化都会收到通知
+            states, current_etag, fields = _get_states(record_ids, task_ids)
+            if current_etag != etag:
+                return states, current_etag
+
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return states, current_etag
+                message = pubsub.get_message(timeout=remaining)
+                if message is not None and fields.intersection(json.loads(message['data'].decode('utf-8'))):
+                    break
+    finally:
+        pubsub.close()
@@ -1,16 +1,133 @@
 # coding=utf-8
 
+import os
 import json
-from urllib import request
+import time
+import atexit
+import logging
+import threading
+import http.client
 from functools import wraps
 
+_reporters = {}
+_reporters_lock = threading.Lock()
+_logger = logging.getLogger(__name__)
 
-def report(host, project_name, task_name):
+
+class Reporter:
+    """缓冲测试结果上报，缓冲数量达到max_size或距上次发送超过interval秒后，通过一个持久连接批量上报。
+
+    进程退出时会自动发送剩余的上报；连接出错或平台返回5xx时按指数退避重试，重试仍失败则将上报放回缓冲区。
+    平台返回4xx时上报本身有误，重试也不会成功，平台已写入批次中其余的上报，只记录被拒绝的上报，不再重试。
+
+    :param host: polaris平台地址。
+    :param max_size: 缓冲的最大上报数量。
+    :param interval: 两次发送的最大间隔（秒）。
+    :param retries: 发送失败后的重试次数。
+    :param backoff: 第一次重试前的等待时间（秒），之后每次翻倍。
+    """
+
+    def __init__(self, host, max_size=100, interval=5, retries=3, backoff=0.5):
+        self.host = host
+        self.max_size = max_size
+        self.interval = interval
+        self.retries = retries
+        self.backoff = backoff
+
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._conn = None
+        self._flusher = None
+
+        atexit.register(self.flush)
+
+    def add(self, data):
+        """加入一条上报，缓冲区满时立即发送。"""
+        with self._lock:
+            self._buffer.append(data)
+            full = len(self._buffer) >= self.max_size
+
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+                self._flusher.start()
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """发送缓冲区中的全部上报。"""
+        with self._send_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+            if not batch:
+                return
+
+            body = '\n'.join(json.dumps(data) for data in batch).encode('utf-8')
+            try:
+                status, content = self._send(body)
+            except (OSError, http.client.HTTPException):
+                with self._lock:
+                    self._buffer = batch + self._buffer
+                raise
+
+            if status != 200:
+                try:
+                    rejected = [batch[i] for i in json.loads(content.decode('utf-8'))['rejected']]
+                except (ValueError, KeyError, TypeError, IndexError):
+                    rejected = batch
+                _logger.warning(f'report results rejected ({status}): {rejected}')
+
+    def _send(self, body):
+        """发送一批上报，连接出错或平台返回5xx时重试。
+
+        :return: 响应状态码和响应内容组成的元组
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                if self._conn is None:
+                    self._conn = http.client.HTTPConnection(self.host, timeout=30)
+
+                self._conn.request('POST', '/records/report_results', body,
+                                   {'Content-Type': 'application/x-ndjson', 'Connection': 'keep-alive'})
+                response = self._conn.getresponse()
+                content = response.read()
+                if response.status >= 500:
+                    raise http.client.HTTPException(f'report results error: {response.status} {response.reason}')
+                return response.status, content
+            except (OSError, http.client.HTTPException):
+                # 连接可能已被服务端关闭，重建连接后重试
+                self._conn.close()
+                self._conn = None
+
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except (OSError, http.client.HTTPException):
+                pass
+
+
+def get_reporter(host):
+    """获取平台地址对应的上报缓冲，同一进程中共享。"""
+    with _reporters_lock:
+        if host not in _reporters:
+            _reporters[host] = Reporter(host)
+        return _reporters[host]
+
+
+def report(host, project_name, task_name, buffered=True):
     """将测试结果上报给平台，测试结果由用户统计并将统计函数注册在该函数下。
 
     :param host: polaris平台地址。
     :param project_name: 项目名。
     :param task_name: 测试任务名。
+    :param buffered: 是否缓冲后批量上报，缓冲的上报在进程退出前发送；为False时立即上报。
     :return: 测试用例数量、出错数量、失败数量、跳过执行数量组成的元组。
 
     示例：
@@ -24,7 +141,6 @@ def report(host, project_name, task_name):
 
     >>> result_statistics()  # 执行统计脚本的命令需在创建任务时的结果统计栏填写
     """
-    url = 'http://{}/records/report_result'.format(host)
 
     def out_wrapper(func):
         @wraps(func)
@@ -34,14 +150,17 @@ def report(host, project_name, task_name):
             data = {
                 'project_name': project_name,
                 'task_name': task_name,
+                'build_number': os.environ.get('BUILD_NUMBER'),  # 在jenkins中执行时由jenkins设置
                 'tests': tests,
                 'errors': errors,
                 'failures': failures,
                 'skip': skip
             }
 
-            req = request.Request(url, data=json.dumps(data).encode('utf-8'))
-            request.urlopen(req)
+            reporter = get_reporter(host)
+            reporter.add(data)
+            if not buffered:
+                reporter.flush()
 
         return wrapper
 
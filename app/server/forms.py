@@ -1,8 +1,8 @@
 # coding=utf-8
 
 from flask_wtf import FlaskForm
-from wtforms import StringField, SubmitField, TextAreaField
-from wtforms.validators import InputRequired, IPAddress
+from wtforms import StringField, SubmitField, TextAreaField, IntegerField
+from wtforms.validators import InputRequired, IPAddress, NumberRange
 from wtforms import ValidationError
 
 from ..models import Server
@@ -13,6 +13,8 @@ class ServerCreateForm(FlaskForm):
     username = StringField('用户名', validators=[InputRequired()])
     password = StringField('密码', validators=[InputRequired()])
     workspace = StringField('工作目录', validators=[InputRequired()])
+    executors = IntegerField('执行器数量', default=5, validators=[InputRequired(), NumberRange(min=1)],
+                             description='可同时执行的任务数')
     info = TextAreaField('描述')
     submit = SubmitField('提交')
 
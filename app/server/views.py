@@ -10,6 +10,8 @@ from jenkins import NotFoundException, JenkinsException
 from . import server
 from .forms import ServerCreateForm, ServerEditForm
 from .. import db, jenkins
+from ..celery_tasks import node_states
+from ..jenkins_api import reconfig_node, enable_node, invalidate_node
 from ..models import Server, OperatingRecord
 
 
@@ -89,12 +91,18 @@ def server_info(server_id):
 
                 current_app.logger.debug('info updated')
 
-            jenkins.reconfig_node(s.host, ET.tostring(root).decode('utf-8'))
+            if form.executors.data != s.executors:
+                root.find('numExecutors').text = str(form.executors.data)
+
+                current_app.logger.debug('executors updated')
+
+            reconfig_node(s.host, ET.tostring(root).decode('utf-8'))
 
             s.host = form.host.data
             s.username = form.username.data
             s.password = form.password.data
             s.workspace = form.workspace.data
+            s.executors = form.executors.data
             s.info = form.info.data
             db.session.add(s)
             operating_record = OperatingRecord(user=current_user, operation='修改', server=s)
@@ -116,6 +124,7 @@ def server_info(server_id):
     form.username.data = s.username
     form.password.data = s.password
     form.workspace.data = s.workspace
+    form.executors.data = s.executors or Server.DEFAULT_EXECUTORS
     form.info.data = s.info
 
     return render_template('server/server.html', form=form, server=s)
@@ -134,14 +143,14 @@ def create():
             current_app.logger.debug(f'credential_id: {credential_id}')
 
             if not jenkins.node_exists(form.host.data):
-                jenkins.create_node(form.host.data, numExecutors=5, nodeDescription=form.info.data,
+                jenkins.create_node(form.host.data, numExecutors=form.executors.data, nodeDescription=form.info.data,
                                     remoteFS=form.workspace.data, labels=form.host.data, exclusive=True,
                                     launcher='hudson.plugins.sshslaves.SSHLauncher',
                                     launcher_params={'port': 22, 'credentialsId': credential_id,
                                                      'host': form.host.data})
 
             s = Server(host=form.host.data, username=form.username.data, password=form.password.data,
-                       workspace=form.workspace.data, info=form.info.data)
+                       workspace=form.workspace.data, executors=form.executors.data, info=form.info.data)
             db.session.add(s)
             operating_record = OperatingRecord(user=current_user, operation='创建', server=s)
             db.session.add(operating_record)
@@ -169,32 +178,23 @@ def create():
 
 @server.route('/check_state/')
 def check_state():
-    """检查服务器在线状态。"""
+    """检查服务器在线状态，读取后台采集的快照。"""
     s = Server.query.get(request.args.get('server_id', type=int))
 
-    try:
-        node_info = jenkins.get_node_info(s.host)
-
-        if not node_info['offline']:
-            s.workspace = node_info['monitorData']['hudson.node_monitors.DiskSpaceMonitor']['path']
-            s.info = node_info['description']
-            os = node_info['monitorData']['hudson.node_monitors.ArchitectureMonitor']
-            disk_space = round(
-                node_info['monitorData']['hudson.node_monitors.DiskSpaceMonitor']['size'] / 1024 / 1024 / 1024, 2)
-            db.session.commit()
+    return jsonify(**node_states([s.host])[0])
 
-            current_app.logger.debug('{} is online'.format(s))
-            return jsonify(state=1, os=os, disk_space=disk_space)
-        else:
-            current_app.logger.debug('{} is offline'.format(s))
-            return jsonify(state=0, os='', disk_space='')
-    except NotFoundException:
-        current_app.logger.warning(f'server {s} not found')
-        return jsonify(state=-1, os='', disk_space='')
-    except JenkinsException as e:
-        current_app.logger.error('jenkins check node state error')
-        current_app.logger.exception(e)
-        return jsonify(state=0, os='', disk_space='')
+
+@server.route('/states')
+def states():
+    """批量检查服务器在线状态，读取后台采集的快照，参数server_id可传入多个。
+
+    state为1：在线，0：离线，-1：jenkins中不存在该服务器，null：尚未采集到状态。
+    """
+    server_ids = request.args.getlist('server_id', type=int)
+    current_app.logger.debug('get {}'.format(url_for('.states', server_id=server_ids)))
+
+    servers = Server.query.filter(Server.id.in_(server_ids)).all() if server_ids else []
+    return jsonify(servers={s.id: state for s, state in zip(servers, node_states([s.host for s in servers]))})
 
 
 @server.route('/enable/')
@@ -204,7 +204,7 @@ def enable():
     server_id = request.args.get('server_id', type=int)
     s = Server.query.get(server_id)
     try:
-        jenkins.enable_node(s.host)
+        enable_node(s.host)
     except NotFoundException:
         # 平台上配置的服务器不在jenkins时会出现此错误
         pass
@@ -226,6 +226,7 @@ def delete():
 
     try:
         jenkins.delete_node(s.host)
+        invalidate_node(s.host)
 
         projects_name = ', '.join([project.name for project in s.projects])
 
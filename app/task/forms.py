@@ -17,6 +17,7 @@ class TaskApplyForm(FlaskForm):
                                       render_kw={'placeholder': '结果统计命令请在此配置'})
     crontab = StringField('定时设置', render_kw={'placeholder': 'crontab (minute hour day month day_of_week)'})
     scheduler_enable = BooleanField('启用定时执行')
+    junit_report = StringField('测试报告', render_kw={'placeholder': '测试服务器上JUnit XML格式测试报告的路径，用于统计各用例的执行结果'})
     email_receivers = StringField('通知邮件收件人地址', render_kw={'placeholder': '多个地址以;分隔'})
     email_body = PageDownField('通知邮件模板', render_kw=dict(rows=8, placeholder='模板使用Markdown格式编辑；\r\n'
                                                                             '不自定义模板则会使用默认模板；\r\n'
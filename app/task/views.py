@@ -1,110 +1,44 @@
 # encoding=utf-8
 
+from datetime import datetime, timedelta
+
 from apscheduler.triggers.cron import CronTrigger
-from flask import render_template, url_for, redirect, abort, flash, current_app, request
+from flask import render_template, url_for, redirect, abort, flash, current_app, request, jsonify
 from flask_login import current_user, login_required
 from jenkins import JenkinsException
 
 from . import task
 from .. import db, scheduler, jenkins
 from .forms import TaskApplyForm, TaskEditForm
-from ..models import Project, Task, Record, OperatingRecord
-
-
-def _create_job(name, info, command, result_statistics, host):
-    """向jenkins添加任务。"""
-    import xml.etree.ElementTree as ET
-
-    project = ET.Element('project')
-
-    project.append(ET.Element('actions'))
-
-    description = ET.Element('description')
-    description.text = info.replace('\r', '')
-    project.append(description)
-
-    keepDependencies = ET.Element('keepDependencies')
-    keepDependencies.text = 'false'
-    project.append(keepDependencies)
-
-    project.append(ET.Element('properties'))
-
-    project.append(ET.Element('scm', {'class': 'hudson.scm.NullSCM'}))
-
-    assignedNode = ET.Element('assignedNode')
-    assignedNode.text = host
-    project.append(assignedNode)
-
-    canRoam = ET.Element('canRoam')
-    canRoam.text = 'false'
-    project.append(canRoam)
-
-    disabled = ET.Element('disabled')
-    disabled.text = 'false'
-    project.append(disabled)
-
-    blockBuildWhenDownstreamBuilding = ET.Element('blockBuildWhenDownstreamBuilding')
-    blockBuildWhenDownstreamBuilding.text = 'false'
-    project.append(blockBuildWhenDownstreamBuilding)
+from ..dispatch import PRIORITIES
+from ..jenkins_api import reconfig_job
+from ..job_config import render_job_config, config_hash
+from ..models import Project, Task, Record, Result, OperatingRecord, TaskDailyStat, TestCaseHistory
 
-    blockBuildWhenUpstreamBuilding = ET.Element('blockBuildWhenUpstreamBuilding')
-    blockBuildWhenUpstreamBuilding.text = 'false'
-    project.append(blockBuildWhenUpstreamBuilding)
 
-    project.append(ET.Element('triggers'))
+def _crontab(form):
+    """表单中启用定时执行且格式正确的crontab。
 
-    concurrentBuild = ET.Element('concurrentBuild')
-    concurrentBuild.text = 'false'
-    project.append(concurrentBuild)
+    :return: 未启用定时执行、未配置crontab或格式错误时返回None，后两种情况会提示用户
+    """
+    if not form.scheduler_enable.data:
+        return None
 
-    builders = ET.Element('builders')
-    ET.SubElement(ET.SubElement(builders, 'hudson.tasks.Shell'), 'command').text = command.replace('\r', '')
-    project.append(builders)
+    if not form.crontab.data:
+        flash('未配置crontab', 'warning')
+        return None
 
-    publishers = ET.Element('publishers')
-    # 结果统计
-    post_build_script = ET.Element('org.jenkinsci.plugins.postbuildscript.PostBuildScript',
-                                   {'plugin': 'postbuildscript@2.7.0'})
-    config = ET.Element('config')
-    build_steps = ET.Element('buildSteps')
-    build_step = ET.Element('org.jenkinsci.plugins.postbuildscript.model.PostBuildStep')
-    results = ET.Element('results')
-    result_success = ET.Element('string')
-    result_success.text = 'SUCCESS'
-    result_failure = ET.Element('string')
-    result_failure.text = 'FAILURE'
-    role = ET.Element('role')
-    role.text = 'BOTH'
-    build_steps_sub = ET.Element('buildSteps')
-    shell = ET.Element('hudson.tasks.Shell')
-    command = ET.Element('command')
-    command.text = result_statistics.replace('\r', '')
-    mark_build_unstable = ET.Element('markBuildUnstable')
-    mark_build_unstable.text = 'false'
-
-    shell.append(command)
-    build_steps_sub.append(shell)
-    results.append(result_failure)
-    results.append(result_success)
-    build_step.append(results)
-    build_step.append(role)
-    build_step.append(build_steps_sub)
-    build_steps.append(build_step)
-    config.append(ET.Element('scriptFiles'))
-    config.append(ET.Element('groovyScripts'))
-    config.append(build_steps)
-    config.append(mark_build_unstable)
-    post_build_script.append(config)
-    publishers.append(post_build_script)
-
-    project.append(publishers)
-
-    project.append(ET.Element('buildWrappers'))
-
-    config = ET.tostring(project).decode('utf-8')
-    jenkins.create_job(name, config)
+    try:
+        # 校验crontab格式
+        scheduler.add_job('temp_id', lambda: None, trigger=CronTrigger.from_crontab(form.crontab.data))
+        scheduler.remove_job('temp_id')
+    except ValueError as e:
+        current_app.logger.error('crontab wrong')
+        current_app.logger.exception(e)
+        flash('crontab格式错误', 'danger')
+        return None
 
-    return config
+    return form.crontab.data
 
 
 @task.route('/')
@@ -117,7 +51,7 @@ def task_list():
         'POLARIS_TASKS_PER_PAGE'], error_out=False)
     t = pagination.items
     p = Project.query.get(project_id)
-    return render_template('task/tasks.html', pagination=pagination, tasks=t, project=p)
+    return render_template('task/tasks.html', pagination=pagination, tasks=t, project=p, priorities=PRIORITIES)
 
 
 @task.route('/<task_id>/', methods=['GET', 'POST'])
@@ -136,85 +70,35 @@ def task_info(task_id):
         current_app.logger.debug('post {}'.format(url_for('.task_info', task_id=task_id)))
 
         try:
-            import xml.etree.ElementTree as ET
+            crontab = _crontab(form)
+            config = render_job_config(form.info.data, p.server.host, form.command.data, form.result_statistics.data,
+                                       crontab)
+            digest = config_hash(config)
 
-            config = jenkins.get_job_config(t.name)
-            root = ET.fromstring(config)
+            # 与上次应用的配置相同时不更新jenkins
+            if digest != t.job_config_hash:
+                current_app.logger.debug('job config updated')
 
-            if form.info.data != t.info:
-                current_app.logger.debug('info updated')
-
-                root.find('description').text = form.info.data
-
-            if form.command.data != t.command:
-                current_app.logger.debug('command updated')
-
-                root.find('builders').find('hudson.tasks.Shell').find('command').text = form.command.data.replace('\r',
-                                                                                                                  '')
-            if form.result_statistics.data != t.result_statistics:
-                current_app.logger.debug('result_statistics updated')
-
-                root.find('.//org.jenkinsci.plugins.postbuildscript.model.PostBuildStep//command').text = \
-                    form.result_statistics.data.replace('\r', '')
-
-            jenkins.reconfig_job(t.name, ET.tostring(root).decode('utf-8'))
+                reconfig_job(t.name, config)
+                t.job_config = config
+                t.job_config_hash = digest
 
             t.nickname = form.name.data
             t.info = form.info.data
             t.command = form.command.data
             t.result_statistics = form.result_statistics.data
+            t.junit_report = form.junit_report.data
+            t.crontab = form.crontab.data
+            t.scheduler_enable = crontab is not None
             t.email_receivers = form.email_receivers.data
             t.email_body = form.email_body.data
             t.email_attachments = form.email_attachments.data
             t.email_notification_enable = form.email_notification_enable.data
 
-            db.session.commit()
-
-            if form.scheduler_enable.data:
-                if form.crontab.data:
-                    current_app.logger.debug('edit trigger of <Task {}>'.format(form.name.data))
-
-                    # 校验crontab格式
-                    scheduler.add_job('temp_id', lambda: None, trigger=CronTrigger.from_crontab(form.crontab.data))
-                    scheduler.remove_job('temp_id')
-
-                    triggers = root.find('triggers')
-                    timer_trigger = triggers.find('hudson.triggers.TimerTrigger')
-                    if timer_trigger:
-                        timer_trigger.find('spec').text = form.crontab.data
-                    else:
-                        timer_trigger = ET.SubElement(triggers, 'hudson.triggers.TimerTrigger')
-                        spec = ET.SubElement(timer_trigger, 'spec')
-                        spec.text = form.crontab.data
-
-                    jenkins.reconfig_job(t.name, ET.tostring(root).decode('utf-8'))
-                    # 防止jenkins出错，对定时的设置单独修改
-                    t.crontab = form.crontab.data
-                    t.scheduler_enable = form.scheduler_enable.data
-                else:
-                    flash('未配置crontab', 'warning')
-                    t.scheduler_enable = False
-            else:
-                triggers = root.find('triggers')
-                timer_trigger = triggers.find('hudson.triggers.TimerTrigger')
-                if timer_trigger:
-                    triggers.remove(timer_trigger)
-                    jenkins.reconfig_job(t.name, ET.tostring(root).decode('utf-8'))
-
-                t.crontab = form.crontab.data
-                t.scheduler_enable = form.scheduler_enable.data
-
             current_app.logger.info(f'{current_user} edited {t}')
             operating_record = OperatingRecord(user=current_user, operation='修改', task=t)
             db.session.add(operating_record)
             db.session.commit()
-        except ValueError as e:
-            t.scheduler_enable = False
-            db.session.commit()
-
-            current_app.logger.error('crontab wrong')
-            current_app.logger.exception(e)
-            flash('crontab格式错误', 'danger')
         except JenkinsException as e:
             current_app.logger.error('jenkins edit job error')
             current_app.logger.exception(e)
@@ -228,6 +112,7 @@ def task_info(task_id):
     form.info.data = t.info
     form.command.data = t.command
     form.result_statistics.data = t.result_statistics
+    form.junit_report.data = t.junit_report
     form.crontab.data = t.crontab
     form.scheduler_enable.data = t.scheduler_enable
     form.email_receivers.data = t.email_receivers
@@ -265,61 +150,29 @@ def create():
             pass
 
         try:
-            _create_job(task_name, form.info.data, form.command.data, form.result_statistics.data, p.server.host)
+            crontab = _crontab(form)
+            config = render_job_config(form.info.data, p.server.host, form.command.data, form.result_statistics.data,
+                                       crontab)
+            jenkins.create_job(task_name, config)
 
             t = Task(name=task_name, nickname=form.name.data, info=form.info.data, command=form.command.data,
-                     result_statistics=form.result_statistics.data, crontab=form.crontab.data,
-                     scheduler_enable=form.scheduler_enable.data, email_receivers=form.email_receivers.data,
-                     email_body=form.email_body.data, email_attachments=form.email_attachments.data,
-                     email_notification_enable=form.email_notification_enable.data, project=p)
+                     result_statistics=form.result_statistics.data, junit_report=form.junit_report.data,
+                     crontab=form.crontab.data, scheduler_enable=crontab is not None,
+                     email_receivers=form.email_receivers.data, email_body=form.email_body.data,
+                     email_attachments=form.email_attachments.data,
+                     email_notification_enable=form.email_notification_enable.data, project=p,
+                     job_config=config, job_config_hash=config_hash(config))
             db.session.add(t)
             db.session.commit()
             current_app.logger.info('{} created the task {}'.format(current_user, t))
 
-            if form.scheduler_enable.data:
-                if form.crontab.data:
-                    current_app.logger.debug('add trigger to <Task {}>'.format(t.name))
-
-                    import xml.etree.ElementTree as ET
-
-                    config = jenkins.get_job_config(t.name)
-                    root = ET.fromstring(config)
-
-                    # 校验crontab格式
-                    scheduler.add_job('temp_id', lambda: None, trigger=CronTrigger.from_crontab(form.crontab.data))
-                    scheduler.remove_job('temp_id')
-
-                    triggers = root.find('triggers')
-                    timer_trigger = ET.SubElement(triggers, 'hudson.triggers.TimerTrigger')
-                    spec = ET.SubElement(timer_trigger, 'spec')
-                    spec.text = form.crontab.data
-
-                    jenkins.reconfig_job(t.name, ET.tostring(root).decode('utf-8'))
-                else:
-                    flash('未配置crontab', 'warning')
-                    t.scheduler_enable = False
-                    db.session.commit()
-
             operating_record = OperatingRecord(user=current_user, operation='创建', task=t)
             db.session.add(operating_record)
             db.session.commit()
-        except ValueError as e:
-            t.scheduler_enable = False
-            db.session.commit()
-
-            current_app.logger.error('crontab wrong')
-            current_app.logger.exception(e)
-            flash('crontab格式错误', 'danger')
         except JenkinsException as e:
             current_app.logger.error('jenkins create job error: {}'.format(e))
             flash('内部错误', 'danger')
 
-            try:
-                t.scheduler_enable = False
-                db.session.commit()
-            except NameError:
-                pass
-
         return redirect(url_for('.task_list', project_id=project_id))
 
     current_app.logger.debug('get {}'.format(url_for('.create', project_id=project_id)))
@@ -343,8 +196,11 @@ def delete():
         jenkins.delete_job(t.name)
 
         for record in t.records:
+            record.test_cases.delete()
             db.session.delete(record.result)
             db.session.delete(record)
+        TaskDailyStat.query.filter_by(task_id=t.id).delete()
+        TestCaseHistory.query.filter_by(task_id=t.id).delete()
 
         db.session.delete(t)
         operating_record = OperatingRecord(user=current_user, operation='删除', task=t)
@@ -358,32 +214,91 @@ def delete():
     return redirect(url_for('.task_list', project_id=project_id))
 
 
+def _pass_rate_series(task_id, limit=None, since=None, until=None):
+    """在数据库中计算任务各次执行的成功率，过滤掉没有统计结果的记录。
+
+    :param task_id: 任务id
+    :param limit: 只取最近的执行次数
+    :param since: 起始时间
+    :param until: 截止日期（包含当天）
+    :return: 按时间顺序排列的版本列表和成功率列表
+    """
+    pass_rate = db.func.round(
+        (Result.tests - Result.errors - Result.skip - Result.failures) * 100.0 / Result.tests, 2)
+    query = db.session.query(Record.version, pass_rate).join(Result, Result.record_id == Record.id).filter(
+        Record.task_id == task_id, Result.tests > 0)
+    if since:
+        query = query.filter(Record.timestamp >= since)
+    if until:
+        # until为日期，包含当天
+        query = query.filter(Record.timestamp < until + timedelta(days=1))
+
+    if limit:
+        rows = query.order_by(Record.timestamp.desc()).limit(limit).all()[::-1]
+    else:
+        rows = query.order_by(Record.timestamp).all()
+
+    return [version for version, _ in rows], [float(value) for _, value in rows]
+
+
+def _date_arg(value):
+    """解析YYYY-MM-DD格式的请求参数。"""
+    return datetime.strptime(value, '%Y-%m-%d')
+
+
 @task.route('/<task_id>/analysis/')
 def analysis(task_id):
     t = Task.query.get(task_id)
-    # 按时间顺序提取出任务的执行记录并过滤掉没有统计结果的记录
-    records = [record for record in sorted(t.records, key=lambda record: record.timestamp) if
-               record.result and record.result.tests]
+    version, value = _pass_rate_series(t.id)
 
     # 折线图默认显示版本数
     show_number_default = 10
     # 计算显示窗口
-    record_len = len(records)
+    record_len = len(version)
     if record_len <= show_number_default:
         zoom_start = 0
     else:
         zoom_start = round(show_number_default / record_len * 100)
 
-    version = [record.version for record in records]
-    value = [round((record.result.tests - record.result.errors - record.result.skip -
-                    record.result.failures) / record.result.tests * 100, 2) for record in records]
-
     page = request.args.get('page', 1, type=int)
 
-    pagination = Record.query.filter_by(task_id=task_id).order_by(
+    pagination = Record.query.options(db.joinedload('result'), db.joinedload('user'), db.joinedload('task'),
+                                      db.joinedload('project')).filter_by(task_id=task_id).order_by(
         Record.timestamp.desc()).paginate(page, per_page=current_app.config['POLARIS_RECORDS_PER_PAGE'],
                                           error_out=False)
 
     all_records = pagination.items
     return render_template('task/analysis.html', task=t, version=version, value=value, records=all_records,
                            project_id=t.project_id, pagination=pagination, zoom_start=zoom_start)
+
+
+@task.route('/<task_id>/analysis/series')
+def analysis_series(task_id):
+    """任务各次执行的版本和成功率序列，可通过limit限制最近的执行次数、通过since和until（YYYY-MM-DD）限制时间范围。"""
+    limit = request.args.get('limit', type=int)
+    since = request.args.get('since', type=_date_arg)
+    until = request.args.get('until', type=_date_arg)
+    current_app.logger.debug('get {}'.format(url_for('.analysis_series', task_id=task_id, limit=limit,
+                                                     since=request.args.get('since'),
+                                                     until=request.args.get('until'))))
+
+    version, value = _pass_rate_series(task_id, limit, since, until)
+    return jsonify(version=version, value=value)
+
+
+@task.route('/<task_id>/analysis/daily')
+def analysis_daily(task_id):
+    """任务每日执行统计，读取预先汇总的数据，可通过since和until（YYYY-MM-DD）限制时间范围。"""
+    since = request.args.get('since', type=_date_arg)
+    until = request.args.get('until', type=_date_arg)
+    current_app.logger.debug('get {}'.format(url_for('.analysis_daily', task_id=task_id,
+                                                     since=request.args.get('since'),
+                                                     until=request.args.get('until'))))
+
+    query = TaskDailyStat.query.filter_by(task_id=task_id)
+    if since:
+        query = query.filter(TaskDailyStat.day >= since.date())
+    if until:
+        query = query.filter(TaskDailyStat.day <= until.date())
+
+    return jsonify(**TaskDailyStat.series(query.order_by(TaskDailyStat.day).all()))
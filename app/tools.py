@@ -1,6 +1,17 @@
 # coding=utf-8
 
+import io
+import math
+import time
+import socket
+import zlib
+import errno
+import struct
+import functools
+import tempfile
+import threading
 import collections
+from contextlib import contextmanager
 
 
 class NestDict(collections.UserDict):
@@ -9,81 +20,287 @@ class NestDict(collections.UserDict):
         return value
 
 
-def get_sftp_file(host, username, password, path, mode='r'):
-    """读取sftp文件，存入临时文件中，支持with as协议，退出后自动删除。"""
-    import paramiko
-    import tempfile
-    import time
-    import os
+class SFTPPool:
+    """测试服务器的ssh连接池。
 
-    transport = paramiko.Transport((host, 22))
-    transport.connect(username=username, password=password)
-    sftp = paramiko.SFTPClient.from_transport(transport)
+    每个服务器复用一个已认证的Transport，每次读取文件时在其上打开新的sftp通道，不再重复握手和认证；
+    连接空闲超过idle_timeout秒后关闭，取用时检查连接是否可用，不可用则重新连接。
+    """
 
-    f_dir = tempfile.gettempdir()
-    f_path = os.path.join(f_dir, 'polaris_' + str(int(time.time())) + '.ret')
-    sftp.get(path, f_path)
+    def __init__(self, idle_timeout=300):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._transports = {}  # (host, username, password) -> (transport, 最后使用时间)
 
-    class C:
-        def __enter__(self):
-            self.f = open(f_path, mode)
-            return self.f
+    def _evict(self, now):
+        for key, (transport, last_used) in list(self._transports.items()):
+            if now - last_used > self.idle_timeout or not transport.is_active():
+                transport.close()
+                del self._transports[key]
 
-        def __exit__(self, exc_type, exc_val, exc_tb):
-            self.f.close()
-            os.remove(f_path)
+    def _get_transport(self, host, username, password, timeout=None):
+        import paramiko
 
-    return C()
+        key = (host, username, password)
+        with self._lock:
+            self._evict(time.time())
+
+            transport = self._transports.get(key, (None, None))[0]
+            if transport is not None and transport.is_authenticated():
+                self._transports[key] = (transport, time.time())
+                return transport
+
+        # 握手和认证在锁外进行，连接慢的服务器不阻塞其他服务器的取用；
+        # 由Transport自行建立连接时没有超时，先以timeout建立socket，握手和认证同样受timeout限制
+        transport = paramiko.Transport(socket.create_connection((host, 22), timeout))
+        if timeout:
+            transport.banner_timeout = transport.auth_timeout = timeout
+        try:
+            transport.connect(username=username, password=password)
+        except Exception:
+            transport.close()
+            raise
+
+        with self._lock:
+            current = self._transports.get(key, (None, None))[0]
+            if current is not None and current.is_authenticated():
+                # 其他线程已先建立了连接，使用其连接，关闭本次建立的连接
+                transport, unused = current, transport
+            else:
+                # 替换已断开的连接
+                unused = current
+            self._transports[key] = (transport, time.time())
+
+        if unused is not None:
+            unused.close()
+        return transport
+
+    def _discard(self, host, username, password):
+        with self._lock:
+            transport, _ = self._transports.pop((host, username, password), (None, None))
+            if transport:
+                transport.close()
+
+    @contextmanager
+    def open_sftp(self, host, username, password, timeout=None):
+        """在服务器的连接上打开一个sftp通道，退出后关闭通道，连接留在池中；需要新建连接时，连接超过timeout秒超时。"""
+        import paramiko
+
+        try:
+            sftp = paramiko.SFTPClient.from_transport(self._get_transport(host, username, password, timeout))
+        except (paramiko.SSHException, EOFError):
+            # 连接已被服务器断开，重新连接一次
+            self._discard(host, username, password)
+            sftp = paramiko.SFTPClient.from_transport(self._get_transport(host, username, password, timeout))
+
+        try:
+            yield sftp
+        finally:
+            sftp.close()
+
+    def close(self):
+        """关闭池中的全部连接。"""
+        with self._lock:
+            for transport, _ in self._transports.values():
+                transport.close()
+            self._transports.clear()
+
+
+sftp_pool = SFTPPool()
+
+
+class SMTPPool:
+    """邮件服务器的连接池。
+
+    每个worker进程对每个（服务器，账号）复用一个已登录的连接，批量发送时不再重复TLS握手和登录；
+    连接空闲超过idle_timeout秒后关闭，取用时用NOOP检查连接是否可用，不可用则重新连接。
+    """
+
+    def __init__(self, idle_timeout=60):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._connections = {}  # (host, username, password, use_ssl) -> (smtp, 最后使用时间)
+
+    def _evict(self, now):
+        for key, (smtp, last_used) in list(self._connections.items()):
+            if now - last_used > self.idle_timeout:
+                self._quit(smtp)
+                del self._connections[key]
+
+    @staticmethod
+    def _quit(smtp):
+        import smtplib
+
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    @staticmethod
+    def _alive(smtp):
+        import smtplib
+
+        try:
+            return smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _get_connection(self, key):
+        import smtplib
+
+        host, username, password, use_ssl = key
+        with self._lock:
+            now = time.time()
+            self._evict(now)
+
+            smtp = self._connections.get(key, (None, None))[0]
+            if smtp is None or not self._alive(smtp):
+                smtp = smtplib.SMTP_SSL(host) if use_ssl else smtplib.SMTP(host)
+                # 本地调试用的邮件服务器可不设置密码，不登录
+                if password:
+                    smtp.login(username, password)
+            self._connections[key] = (smtp, now)
+            return smtp
+
+    def _discard(self, key):
+        with self._lock:
+            smtp, _ = self._connections.pop(key, (None, None))
+            if smtp:
+                smtp.close()
+
+    @contextmanager
+    def connection(self, host, username, password, use_ssl=True):
+        """取用服务器的已登录连接，退出后连接留在池中；使用中连接断开时将其移出连接池。"""
+        import smtplib
+
+        key = (host, username, password, use_ssl)
+        try:
+            yield self._get_connection(key)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            self._discard(key)
+            raise
+
+    def close(self):
+        """关闭池中的全部连接。"""
+        with self._lock:
+            for smtp, _ in self._connections.values():
+                self._quit(smtp)
+            self._connections.clear()
+
+
+smtp_pool = SMTPPool()
+
+SPOOL_MAX_SIZE = 10 * 1024 * 1024  # 读取的文件小于该大小时只存放在内存中
+
+
+@contextmanager
+def get_sftp_file(host, username, password, path, mode='r', max_size=None, timeout=None):
+    """读取sftp文件，支持with as协议。
+
+    连接从sftp_pool中取用，文件内容读入内存，超过SPOOL_MAX_SIZE时转存匿名临时文件，退出后自动释放。
+    文件大于max_size时抛出errno为EFBIG的OSError；连接或读取中超过timeout秒无响应时抛出socket.timeout。
+    """
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as fp:
+        with sftp_pool.open_sftp(host, username, password, timeout) as sftp:
+            if timeout:
+                sftp.get_channel().settimeout(timeout)
+            if max_size is not None and sftp.stat(path).st_size > max_size:
+                raise OSError(errno.EFBIG, 'file too large', path)
+            sftp.getfo(path, fp)
+        fp.seek(0)
+
+        yield fp if 'b' in mode else io.StringIO(fp.read().decode('utf-8'))
+
+
+ANALYSIS_PIC_SIZE = 200  # 结果饼图的边长（像素）
+ANALYSIS_PIC_RESOLUTION = 1000  # 各部分占比归一化的精度，占比相同的结果共用缓存的图片
+ANALYSIS_PIC_SLICES = (('failures', (255, 0, 0)), ('pass', (154, 205, 50)), ('skip', (135, 206, 250)),
+                       ('errors', (255, 255, 0)))
+
+
+def _png_chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+
+def _encode_png(width, height, rows):
+    """将RGBA像素行编码为png。"""
+    raw = b''.join(b'\x00' + row for row in rows)  # 每行前加滤波类型0
+    return (b'\x89PNG\r\n\x1a\n' +
+            _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) +
+            _png_chunk(b'IDAT', zlib.compress(raw, 9)) +
+            _png_chunk(b'IEND', b''))
+
+
+@functools.lru_cache(maxsize=256)
+def _render_pie(shares):
+    """绘制饼图，从正上方开始按逆时针依次绘制各部分，圆周边缘做抗锯齿。
+
+    :param shares: 与ANALYSIS_PIC_SLICES对应的各部分归一化占比
+    :type shares: tuple
+    :return: png图片的二进制内容
+    """
+    total = sum(shares)
+    bounds = []  # 各部分结束处占整圆的比例及颜色
+    accumulated = 0
+    for share, (_, color) in zip(shares, ANALYSIS_PIC_SLICES):
+        if share:
+            accumulated += share
+            bounds.append((accumulated / total, bytes(color)))
+    if not bounds:
+        bounds.append((1, bytes((211, 211, 211))))
+
+    size = ANALYSIS_PIC_SIZE
+    center = (size - 1) / 2
+    radius = size / 2 - 1
+    transparent = bytes(4)
+
+    rows = []
+    for y in range(size):
+        row = bytearray()
+        dy = center - y
+        for x in range(size):
+            dx = x - center
+            alpha = radius + 0.5 - math.hypot(dx, dy)
+            if alpha <= 0:
+                row += transparent
+                continue
+
+            position = (math.atan2(dy, dx) / (2 * math.pi) - 0.25) % 1
+            for bound, color in bounds:
+                if position < bound:
+                    break
+            row += color
+            row.append(255 if alpha >= 1 else int(255 * alpha))
+        rows.append(bytes(row))
+
+    return _encode_png(size, size, rows)
+
+
+def _normalize(counts):
+    """将各部分数量归一化为ANALYSIS_PIC_RESOLUTION精度的占比，数量不为0的部分至少保留1。"""
+    counts = [max(count, 0) for count in counts]
+    total = sum(counts)
+    if not total:
+        return (0,) * len(counts)
+    return tuple(max(1, round(count * ANALYSIS_PIC_RESOLUTION / total)) if count else 0 for count in counts)
 
 
 def gen_analysis_pic(failure_count, success_count, skip_count, error_count):
-    from io import BytesIO
-    import matplotlib
-    matplotlib.use('Agg')
-
-    from matplotlib import pyplot as plt
-
-    plt.rcParams['font.sans-serif'] = ['SimHei']
-    plt.figure(figsize=(3, 4))
-
-    labels = []
-    sizes = []
-    colors = []
-    explode = []
-    if failure_count:
-        labels.append('failures')
-        sizes.append(failure_count)
-        colors.append('red')
-        explode.append(0)
-    if success_count:
-        labels.append('pass')
-        sizes.append(success_count)
-        colors.append('yellowgreen')
-        explode.append(0)
-    if skip_count:
-        labels.append('skip')
-        sizes.append(skip_count)
-        colors.append('lightskyblue')
-        explode.append(0)
-    if error_count:
-        labels.append('errors')
-        sizes.append(error_count)
-        colors.append('yellow')
-        explode.append(0)
-
-    explode = tuple(explode)
-    _, _, _ = plt.pie(sizes,
-                      explode=explode,
-                      labels=labels,
-                      colors=colors,
-                      autopct='%3.2f%%',  # 数值保留固定小数位
-                      shadow=False,  # 无阴影设置
-                      startangle=90,  # 逆时针起始角度设置
-                      pctdistance=0.6,  # 数值距圆心半径倍数的距离
-                      labeldistance=1.2)
-    plt.axis('equal')
-
-    figfile = BytesIO()
-    plt.savefig(figfile, format='png')
-    figfile.seek(0)
-    return figfile.getvalue()
+    """生成测试结果的饼图，不依赖绘图库，直接编码为png；图例由analysis_legend以html形式生成。
+
+    :return: png图片的二进制内容
+    """
+    return _render_pie(_normalize((failure_count, success_count, skip_count, error_count)))
+
+
+def analysis_legend(failure_count, success_count, skip_count, error_count):
+    """生成饼图的html图例，包含各部分的颜色、数量和占比。"""
+    counts = [max(count, 0) for count in (failure_count, success_count, skip_count, error_count)]
+    total = sum(counts) or 1
+
+    items = []
+    for count, (label, color) in zip(counts, ANALYSIS_PIC_SLICES):
+        if count:
+            items.append(f'<span style="display:inline-block;width:10px;height:10px;'
+                         f'background:rgb{color}"></span> {label} {count} ({count * 100 / total:.2f}%)')
+    return '<br>'.join(items)
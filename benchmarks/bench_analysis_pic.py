@@ -0,0 +1,127 @@
+# coding=utf-8
+
+"""
+通知邮件结果饼图的生成耗时和内存对比：原matplotlib实现与现在不依赖绘图库的png实现（tools.gen_analysis_pic）。
+
+每种实现在单独的子进程中生成charts张饼图，各图的结果数量从distinct组随机结果中抽取（定时任务的结果大多重复），
+统计首张耗时、平均耗时，以及生成前后进程的常驻内存。未安装matplotlib时跳过原实现。
+tools.py的饼图部分只依赖标准库，直接按文件加载，不需要安装平台的依赖。
+
+在项目根目录执行：
+>>> python3 benchmarks/bench_analysis_pic.py --charts 500 --distinct 50
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import warnings
+import argparse
+import subprocess
+import importlib.util
+
+
+def _rss():
+    """当前进程的常驻内存（MB）。"""
+    with open('/proc/self/status') as fp:
+        for line in fp:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0
+
+
+def gen_analysis_pic_matplotlib(failure_count, success_count, skip_count, error_count):
+    """原实现，每次调用新建图形且不关闭。"""
+    from io import BytesIO
+    import matplotlib
+    matplotlib.use('Agg')
+
+    from matplotlib import pyplot as plt
+
+    plt.rcParams['font.sans-serif'] = ['SimHei']
+    plt.figure(figsize=(3, 4))
+
+    labels, sizes, colors = [], [], []
+    for count, label, color in ((failure_count, 'failures', 'red'), (success_count, 'pass', 'yellowgreen'),
+                                (skip_count, 'skip', 'lightskyblue'), (error_count, 'errors', 'yellow')):
+        if count:
+            labels.append(label)
+            sizes.append(count)
+            colors.append(color)
+
+    plt.pie(sizes, explode=(0,) * len(sizes), labels=labels, colors=colors, autopct='%3.2f%%', shadow=False,
+            startangle=90, pctdistance=0.6, labeldistance=1.2)
+    plt.axis('equal')
+
+    figfile = BytesIO()
+    plt.savefig(figfile, format='png')
+    return figfile.getvalue()
+
+
+def _load_tools():
+    spec = importlib.util.spec_from_file_location(
+        'tools', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app', 'tools.py'))
+    tools = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(tools)
+    return tools
+
+
+def run(renderer, charts, distinct):
+    """在当前进程中生成饼图，返回统计结果。"""
+    rng = random.Random(0)
+    results = []
+    for _ in range(distinct):
+        tests = rng.randint(1, 500)
+        failures = rng.randint(0, tests // 5)
+        errors = rng.randint(0, tests // 10)
+        skip = rng.randint(0, tests // 10)
+        results.append((failures, max(tests - failures - errors - skip, 0), skip, errors))
+    counts = [rng.choice(results) for _ in range(charts)]
+
+    rss_before = _rss()
+    if renderer == 'matplotlib':
+        # 没有SimHei字体时每张图都会输出警告；图形未关闭的警告即原实现内存增长的原因，结果中体现为rss after
+        logging.getLogger('matplotlib.font_manager').setLevel(logging.ERROR)
+        warnings.filterwarnings('ignore', 'More than 20 figures', RuntimeWarning)
+        render = gen_analysis_pic_matplotlib
+    else:
+        render = _load_tools().gen_analysis_pic
+
+    times = []
+    for count in counts:
+        start = time.perf_counter()
+        render(*count)
+        times.append(time.perf_counter() - start)
+
+    return {'first': times[0] * 1000, 'mean': sum(times) / len(times) * 1000, 'rss_before': rss_before,
+            'rss_after': _rss()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--charts', type=int, default=500, help='生成的饼图数量')
+    parser.add_argument('--distinct', type=int, default=50, help='不同结果的组数')
+    parser.add_argument('--renderer', choices=['matplotlib', 'png'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.renderer:
+        print(json.dumps(run(args.renderer, args.charts, args.distinct)))
+        return
+
+    print(f'{"renderer":<12} {"first":>10} {"mean":>10} {"rss before":>12} {"rss after":>12}')
+    for renderer in ('matplotlib', 'png'):
+        if renderer == 'matplotlib' and importlib.util.find_spec('matplotlib') is None:
+            print(f'{renderer:<12} skipped: matplotlib not installed')
+            continue
+
+        output = subprocess.run([sys.executable, __file__, '--renderer', renderer, '--charts', str(args.charts),
+                                 '--distinct', str(args.distinct)], stdout=subprocess.PIPE, check=True).stdout
+        stats = json.loads(output)
+        print(f'{renderer:<12} {stats["first"]:8.2f}ms {stats["mean"]:8.3f}ms {stats["rss_before"]:10.1f}MB '
+              f'{stats["rss_after"]:10.1f}MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# coding=utf-8
+
+"""
+状态检查的耗时：运行实际的check_state任务，对比jenkins请求逐个串行（1个线程）与在有界线程池中并发。
+
+启动一个模拟的jenkins，每个请求固定延迟latency毫秒；每个任务有一个新构建，其中finished比例的构建已结束，需要读取控制台输出。
+使用testing配置（默认为内存sqlite数据库），TEST_JENKINS_HOST指向模拟的jenkins，每轮重建数据库后调用一次check_state，
+POLARIS_JENKINS_POLL_WORKERS分别为1和workers。结果上报和状态变化通知使用redis，需要本地运行redis。
+
+在项目根目录执行：
+>>> python3 benchmarks/bench_check_state.py --jobs 500 --latency 20 --workers 8
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakeJenkins(BaseHTTPRequestHandler):
+    latency = 0.02
+    finished = 0.1
+    requests = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if parts[0] != 'job':
+            # 不开启CSRF保护，crumbIssuer不存在
+            self.send_error(404)
+            return
+
+        with self.lock:
+            type(self).requests += 1
+        time.sleep(self.latency)
+
+        job = int(parts[1].split('-')[1])
+        done = job % round(1 / self.finished) == 0 if self.finished else False
+        if parts[-1] == 'consoleText':
+            body = b'console output\n' * 100
+        else:  # job/<name>/api/json
+            body = json.dumps({'builds': [{'number': 1, 'result': 'SUCCESS' if done else None, 'duration': 1000,
+                                           'queueId': None}]}).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _setup(db, jobs):
+    from app.models import Server, Project, Task
+
+    db.drop_all()
+    db.create_all()
+    server = Server(host='127.0.0.1', username='tester', password='tester', workspace='/tmp')
+    project = Project(name='bench', server=server, allowed=True)
+    db.session.add_all([server, project])
+    db.session.add_all(Task(project=project, nickname=name, name=name) for name in jobs)
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--jobs', type=int, default=500, help='任务数')
+    parser.add_argument('--latency', type=float, default=20, help='模拟jenkins每个请求的延迟（毫秒）')
+    parser.add_argument('--finished', type=float, default=0.1, help='本次检查中已结束构建的比例')
+    parser.add_argument('--workers', type=int, default=8, help='并发时的线程池大小，对应POLARIS_JENKINS_POLL_WORKERS')
+    args = parser.parse_args()
+
+    FakeJenkins.latency = args.latency / 1000
+    FakeJenkins.finished = args.finished
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeJenkins)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # 应用在导入时按环境变量创建
+    os.environ['POLARIS_CONFIG'] = 'testing'
+    os.environ['TEST_JENKINS_HOST'] = f'127.0.0.1:{server.server_address[1]}'
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app import app, db
+    from app.models import Record
+    from app.celery_tasks import check_state
+
+    jobs = [f'job-{i}' for i in range(args.jobs)]
+    results = []
+    for workers in (1, args.workers):
+        with app.app_context():
+            _setup(db, jobs)
+            app.config['POLARIS_JENKINS_POLL_WORKERS'] = workers
+
+            FakeJenkins.requests = 0
+            start = time.perf_counter()
+            check_state()
+            elapsed = time.perf_counter() - start
+
+            finished = Record.query.filter_by(state=1).count()
+            results.append(elapsed)
+            print(f'{f"workers={workers}":<12} {FakeJenkins.requests:>6} requests  {finished:>5} finished  '
+                  f'{elapsed:8.2f} s')
+
+    print(f'speedup {results[0] / results[1]:.1f}x')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# coding=utf-8
+
+"""
+测试结果上报的吞吐量对比：每次上报一个请求且不复用连接（原report）、复用持久连接逐条上报（buffered=False）、
+缓冲后批量上报（buffered=True）。
+
+启动一个模拟平台上报接口的本地服务，report_result和report_results接口的每个请求固定延迟latency毫秒，
+统计每秒上报的数量。report_result.py只依赖标准库，直接按文件加载，不需要安装平台的依赖。
+
+在项目根目录执行：
+>>> python3 benchmarks/bench_report.py --reports 2000 --latency 1
+"""
+
+import os
+import json
+import time
+import argparse
+import threading
+import importlib.util
+from urllib import request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+_spec = importlib.util.spec_from_file_location(
+    'report_result', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app',
+                                  'report_result.py'))
+report_result = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(report_result)
+
+
+class FakePolaris(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 支持持久连接
+    disable_nagle_algorithm = True  # 响应头和响应体分两次写入，避免与客户端的延迟确认叠加
+    latency = 0.001
+    requests = 0
+    reports = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        count = len([line for line in body.splitlines() if line.strip()])
+        with self.lock:
+            type(self).requests += 1
+            type(self).reports += count
+        time.sleep(self.latency)
+
+        data = json.dumps({'status': 0, 'msg': 'ok', 'count': count}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def _result():
+    return 5, 1, 1, 0
+
+
+def single(host, reports):
+    """原report：每次上报新建连接发送一个请求。"""
+    url = f'http://{host}/records/report_result'
+    for _ in range(reports):
+        tests, errors, failures, skip = _result()
+        data = {'project_name': 'bench', 'task_name': 't', 'tests': tests, 'errors': errors, 'failures': failures,
+                'skip': skip}
+        request.urlopen(request.Request(url, data=json.dumps(data).encode('utf-8'))).read()
+
+
+def reporter(host, reports, buffered):
+    """现report：通过同一个Reporter上报，buffered为False时每次上报立即发送。"""
+    statistics = report_result.report(host, 'bench', 't', buffered=buffered)(_result)
+    for _ in range(reports):
+        statistics()
+    report_result.get_reporter(host).flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--reports', type=int, default=2000, help='上报次数')
+    parser.add_argument('--latency', type=float, default=1, help='模拟平台处理每个请求的延迟（毫秒）')
+    args = parser.parse_args()
+
+    FakePolaris.latency = args.latency / 1000
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakePolaris)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = f'127.0.0.1:{server.server_address[1]}'
+
+    rates = []
+    for label, run in (('single', lambda: single(host, args.reports)),
+                       ('keep-alive', lambda: reporter(host, args.reports, buffered=False)),
+                       ('buffered', lambda: reporter(host, args.reports, buffered=True))):
+        FakePolaris.requests = FakePolaris.reports = 0
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        assert FakePolaris.reports == args.reports, f'{label}: {FakePolaris.reports} reports received'
+        rates.append(args.reports / elapsed)
+        print(f'{label:<12} {FakePolaris.requests:>6} requests  {elapsed:7.2f} s  {rates[-1]:9.0f} reports/s')
+
+    print(f'buffered vs single {rates[2] / rates[0]:.1f}x')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# coding=utf-8
+
+"""
+检查列表页面执行的sql数不随行数增加。
+
+使用testing配置（默认为内存sqlite数据库），分别在每页只有少量行和整页行时请求执行记录列表、任务列表和任务统计页面，
+比较响应头X-Query-Count，数量不一致时说明页面存在逐行懒加载，以非0状态退出。
+
+在项目根目录执行：
+>>> python3 benchmarks/check_query_count.py
+"""
+
+import os
+import sys
+
+os.environ['POLARIS_CONFIG'] = 'testing'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db  # noqa: E402
+from app.models import Role, User, Server, Project, Task, Record, Result  # noqa: E402
+
+
+def _setup():
+    db.create_all()
+    Role.insert_roles()
+
+    user = User(email='tester@example.com', password='tester')
+    server = Server(host='127.0.0.1', username='tester', password='tester', workspace='/tmp')
+    project = Project(name='query-count', server=server, allowed=True)
+    project.testers.append(user)
+    db.session.add_all([user, server, project])
+    db.session.commit()
+    return user.id, project.id
+
+
+def _grow(project_id, user_id, rows):
+    """将项目的任务、第一个任务的执行记录各补充到rows个，不显式设置记录状态，不触发状态变化通知。
+
+    :return: 第一个任务的id
+    """
+    project = Project.query.get(project_id)
+    for i in range(project.tasks.count(), rows):
+        db.session.add(Task(project=project, nickname=f'task{i}', name=f'{project.name}_task{i}'))
+    db.session.flush()
+
+    task = project.tasks.order_by(Task.id).first()
+    user = User.query.get(user_id)
+    for i in range(project.records.count(), rows):
+        record = Record(user=user, project=project, task=task, version=f'1.0.{i}', build_number=i + 1)
+        db.session.add_all([record, Result(record=record, status=0, tests=10, errors=0, failures=1, skip=0)])
+    db.session.commit()
+    return task.id
+
+
+def _query_counts(client, project_id, task_id):
+    urls = [f'/records/?project_id={project_id}&task_id=-1',
+            f'/tasks/?project_id={project_id}',
+            f'/tasks/{task_id}/analysis/']
+
+    counts = {}
+    for url in urls:
+        response = client.get(url)
+        assert response.status_code == 200, f'{url}: {response.status_code}'
+        counts[url] = int(response.headers['X-Query-Count'])
+    return counts
+
+
+def main():
+    with app.app_context():
+        user_id, project_id = _setup()
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        # flask-login 0.4使用user_id，之后的版本使用_user_id
+        session['user_id'] = session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+    results = []
+    for rows in (2, app.config['POLARIS_RECORDS_PER_PAGE']):
+        # 请求之间不保留应用上下文，每个请求单独计数
+        with app.app_context():
+            task_id = _grow(project_id, user_id, rows)
+        results.append(_query_counts(client, project_id, task_id))
+
+    failed = False
+    for url in results[0]:
+        counts = [counts[url] for counts in results]
+        failed |= len(set(counts)) != 1
+        print(f'{url:<40} {" -> ".join(map(str, counts))}{"" if len(set(counts)) == 1 else "  NOT CONSTANT"}')
+
+    with app.app_context():
+        db.drop_all()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,24 @@ class Config:
     POLARIS_TASKS_PER_PAGE = 20
     POLARIS_PROJECTS_PER_PAGE = 20
     POLARIS_SERVERS_PER_PAGE = 10
+    POLARIS_JENKINS_POLL_WORKERS = 8  # 状态检查时对jenkins的最大并发请求数
+    POLARIS_STATES_MAX_WAIT = 30  # 执行记录状态长轮询的最长等待时间（秒）
+    # 每个进程同时长轮询等待的最大请求数，等待的请求占用worker，需以多线程或协程方式部署
+    POLARIS_STATES_MAX_WAITERS = 50
+    POLARIS_DISPATCH_START_TIMEOUT = 600  # 派发到jenkins的构建超过该时间（秒）仍未开始执行时取消，重新回到等待队列
+    POLARIS_MIGRATION_WORKERS = 8  # 修改项目测试服务器时并发修改的任务数
+    # jenkins查询接口的缓存时间（秒），finished_build为已结束构建的缓存时间
+    POLARIS_JENKINS_CACHE_TTL = {'build': 5, 'finished_build': 3600, 'node': 10}
+
+    # 通知邮件附件的读取
+    POLARIS_ATTACHMENT_WORKERS = 4  # 并发读取数
+    POLARIS_ATTACHMENT_MAX_SIZE = 20 * 1024 * 1024  # 单个附件的大小上限（字节），超过时不发送该附件
+    POLARIS_ATTACHMENT_TIMEOUT = 60  # 单个附件读取无响应的超时时间（秒）
+    POLARIS_MAIL_BATCH_SIZE = 50  # 每次从发送队列取出的邮件数
+
+    # jenkins构建事件推送，POLARIS_URL需能被jenkins访问，为空时不在任务中配置推送
+    POLARIS_URL = os.environ.get('POLARIS_URL') or ''
+    POLARIS_BUILD_EVENT_TOKEN = os.environ.get('POLARIS_BUILD_EVENT_TOKEN') or ''
 
     @classmethod
     def init_app(cls, app):
@@ -35,16 +53,28 @@ class DevelopmentConfig(Config):
     EMAIL_HOST = ''
     EMAIL_SENDER = ''
     EMAIL_SENDER_PASSWORD = ''
+    EMAIL_USE_SSL = True  # 使用本地调试邮件服务器时设为False，EMAIL_SENDER_PASSWORD为空时不登录
 
     CELERY_BROKER_URL = 'redis://localhost:6379'
     CELERY_RESULT_BACKEND = 'redis://localhost:6379'
     CELERY_REDIRECT_STDOUTS_LEVEL = 'info'
-    CELERY_TASK_SERIALIZER = 'pickle'
-    CELERY_ACCEPT_CONTENT = ['pickle']
+    # 任务参数只包含可json序列化的小数据，较大的内容通过app.blob_store传递引用
+    CELERY_TASK_SERIALIZER = 'json'
+    CELERY_RESULT_SERIALIZER = 'json'
+    CELERY_ACCEPT_CONTENT = ['json']
     CELERYBEAT_SCHEDULE = {
                               'check_state': {
                                   'task': 'app.celery_tasks.check_state',
-                                  'schedule': timedelta(seconds=300)
+                                  # 构建结束由jenkins推送，定时检查只用于补偿遗漏的事件
+                                  'schedule': timedelta(seconds=900)
+                              },
+                              'check_dispatched': {
+                                  'task': 'app.celery_tasks.check_dispatched',
+                                  'schedule': timedelta(seconds=30)
+                              },
+                              'collect_nodes': {
+                                  'task': 'app.celery_tasks.collect_nodes',
+                                  'schedule': timedelta(seconds=10)
                               }
                           }
 
@@ -66,6 +96,20 @@ class DevelopmentConfig(Config):
 
 class TestingConfig(Config):
     TESTING = True
+    WTF_CSRF_ENABLED = False
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or 'sqlite://'
+
+    JENKINS_HOST = os.environ.get('TEST_JENKINS_HOST') or ''
+    JENKINS_USERNAME = ''
+    JENKINS_PASSWORD = ''
+
+    EMAIL_HOST = ''
+    EMAIL_SENDER = ''
+    EMAIL_SENDER_PASSWORD = ''
+    EMAIL_USE_SSL = False
+
+    CELERY_BROKER_URL = 'memory://'
 
 
 class ProductionConfig(Config):
@@ -1,7 +1,8 @@
 # coding=utf-8
 
 from app import db, app
-from app.models import User, Role, Task, Result, Project, Record, Manual, EmailTemplate, OperatingRecord
+from app.models import (User, Role, Task, Result, ConsoleChunk, Project, Record, Manual, EmailTemplate,
+                        OperatingRecord, TaskDailyStat, ProjectDailyStat)
 from flask_script import Manager, Shell, Server
 from flask_migrate import MigrateCommand
 
@@ -9,13 +10,43 @@ manager = Manager(app)
 
 
 def make_shell_context():
-    return dict(app=app, db=db, User=User, Role=Role, Task=Task, Result=Result, Project=Project, Record=Record,
-                Manual=Manual, EmailTemplate=EmailTemplate, OperatingRecord=OperatingRecord)
+    return dict(app=app, db=db, User=User, Role=Role, Task=Task, Result=Result, ConsoleChunk=ConsoleChunk,
+                Project=Project, Record=Record, Manual=Manual, EmailTemplate=EmailTemplate,
+                OperatingRecord=OperatingRecord, TaskDailyStat=TaskDailyStat, ProjectDailyStat=ProjectDailyStat)
 
 
 manager.add_command('shell', Shell(make_context=make_shell_context))
 manager.add_command('runserver', Server(host='0.0.0.0'))
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def compress_console():
+    """将旧数据中直接存放在results表的命令行输出转为压缩分块存储。"""
+    result_ids = [result_id for result_id, in db.session.query(Result.id).filter(Result.cmd_line.isnot(None))]
+    for result_id in result_ids:
+        result = Result.query.get(result_id)
+        result.set_console(result.cmd_line)
+        db.session.commit()
+
+
+@manager.command
+def rebuild_stats():
+    """根据全部执行记录重新生成任务和项目的每日统计。"""
+    TaskDailyStat.rebuild()
+    ProjectDailyStat.rebuild()
+
+
+@manager.command
+def jenkins_cache_stats():
+    """显示jenkins查询缓存的命中情况。"""
+    from app.jenkins_api import cache_stats
+
+    for method, stats in sorted(cache_stats().items()):
+        total = sum(stats.values())
+        print(f'{method}: hit {stats["hit"]}, coalesced {stats["coalesced"]}, miss {stats["miss"]}, '
+              f'saved {(total - stats["miss"]) / total:.2%}' if total else f'{method}: no request')
+
+
 if __name__ == '__main__':
     manager.run()